@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+import sys
+import time
+import argparse
+import threading
+from datetime import timedelta
+from main import Backend, Command, Pacer
+from scheduler import Scheduler
+
+""" Headless measurement campaign
+runs Backend.process with a Scheduler position sequence in a worker thread,
+the main thread only prints throughput and ETA. Ctrl+C stops after the current
+exchange, finished positions are kept in the checkpoint.
+
+    python campaign.py --array 8 8 --r 50 300 50 --theta 0 45 5 -o ./log/run1.csv --checkpoint run1.json
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="headless measurement campaign")
+    parser.add_argument('--array', type=int, nargs=2, default=(4, 4), metavar=('M', 'N'), help="PA array size")
+    parser.add_argument('--peri', type=int, default=5, help="number of peripherals")
+    parser.add_argument('--r', type=float, nargs=3, default=(50, 300, 100), metavar=('START', 'STOP', 'STEP'),
+                        help="distance range in cm, inclusive")
+    parser.add_argument('--theta', type=float, nargs=3, default=(0, 45, 10), metavar=('START', 'STOP', 'STEP'),
+                        help="θ range in degrees, inclusive")
+    parser.add_argument('--phi', type=float, nargs=3, default=(180, 360, 60), metavar=('START', 'STOP', 'STEP'),
+                        help="φ range in degrees, inclusive")
+    parser.add_argument('-o', '--output', default=None, help="CSV log path (default: ./log/<timestamp>.csv)")
+    parser.add_argument('--checkpoint', default=None, help="progress file, resumed if it matches the grid")
+    parser.add_argument('--no-optimize', action='store_true', help="keep the grid order")
+    parser.add_argument('--rate', type=float, default=1000, help="exchange rate between commands (pkt/s)")
+    parser.add_argument('--interval', type=float, default=1.0, help="progress print interval (sec)")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    scheduler = Scheduler(tuple(args.r), tuple(args.theta), tuple(args.phi),
+                          checkpoint=args.checkpoint, optimize=not args.no_optimize)
+    backend = Backend(tx_num=args.array[0] * args.array[1], peri_num=args.peri, scheduler=scheduler,
+                      pacer=Pacer(rate=args.rate), log_path=args.output)
+    backend.verbose = False
+    total = backend.end - backend.start
+    if total <= 0:
+        print("nothing to measure")
+        return 0
+
+    finished = threading.Event()
+    pacer_stats = {}
+
+    def listener(event, *args):
+        match event:
+            case 'edge':
+                if args == (Command.SCAN, -1) and backend.pos_idx >= backend.end:
+                    finished.set()
+            case 'pacer':
+                pacer_stats.update(args[0])
+
+    backend.add_listener(listener)
+    streamer = threading.Thread(target=backend.process, daemon=True)
+    streamer.start()
+
+    end = "\r" if sys.stdout.isatty() else "\n"
+    t0 = time.monotonic()
+    try:
+        while streamer.is_alive() and not finished.wait(args.interval):
+            done = backend.pos_idx - backend.start
+            elapsed = time.monotonic() - t0
+            rate = done / elapsed
+            eta = timedelta(seconds=round((total - done) / rate)) if rate else "-"
+            print(f"{done} / {total} ({done / total * 100:.1f}%)  {rate * 60:.1f} pos/min  ETA {eta}  |  "
+                  f"{backend.status.name.lower()}  {pacer_stats.get('rate', 0):.0f} pkt/s  "
+                  f"cpu {pacer_stats.get('cpu', 0):.0f}%", end=end, flush=True)
+    except KeyboardInterrupt:
+        print("\nstopping")
+    finally:
+        backend.stop()
+        streamer.join()  # returns after the current exchange, at most the 2 s socket timeout
+        backend.close_log()  # no more records can arrive, the checkpoint follows the last written one
+
+    if finished.is_set():
+        print(f"\ndone: {total} positions in {timedelta(seconds=round(time.monotonic() - t0))}")
+        return 0
+    print(f"{scheduler.done} / {len(scheduler)} positions done")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -1,12 +1,15 @@
 import os
+import json
+import hashlib
 import logging
 import warnings
 import numpy as np
 from random import randint
 from datetime import datetime
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from sim import Esa
+from scheduler import get_position_grid
 
 if 0:
     esa = Esa(4, 4)
@@ -18,19 +21,43 @@ phase_step = 360 / (1 << ps_n_bits)
 ps_code_limit = 1 << ps_n_bits
 
 """ power per distance approximation
+fitted on first use and cached to disk
 """
-warnings.filterwarnings('ignore')
 xs = np.array([50, 100, 150, 200, 250, 300, 350, 400, 450, 500])
 ys = np.array([1600, 950, 690, 600, 520, 435, 395, 365, 305, 260])
+fit_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'power_fit.json')
 def func(xs, a, b, c):
     ys = a * np.exp(-b * xs) + c
     return ys
-popt, pcov = curve_fit(func, xs, ys, p0=(2, 1e-2, 3))
+
+@lru_cache(maxsize=None)
+def get_power_fit():
+    key = hashlib.sha1(xs.tobytes() + ys.tobytes()).hexdigest()
+    try:
+        with open(fit_cache) as f:
+            cache = json.load(f)
+        if cache['key'] == key:
+            return tuple(cache['popt'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from scipy.optimize import curve_fit
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        popt, pcov = curve_fit(func, xs, ys, p0=(2, 1e-2, 3))
+    try:
+        os.makedirs(os.path.dirname(fit_cache), exist_ok=True)
+        with open(fit_cache, 'w') as f:
+            json.dump({'key': key, 'popt': popt.tolist()}, f)
+    except OSError:
+        pass
+    return tuple(popt)
 
 def predict_power(d):
-    return func(d, *popt)
+    return func(d, *get_power_fit())
 
-if False:
+def plot_power_fit():
+    import matplotlib.pyplot as plt
     plt.plot(xs, ys, marker='.', label='real')
     ys2 = predict_power(xs)
     plt.plot(xs, ys2, marker='*', label='approximated')
@@ -39,6 +66,14 @@ if False:
     plt.show()
 
 
+def get_header():
+    s = "rx#, R, θ, φ"
+    for i in range(esa.tx_num):
+        s += f", ps#{i}"
+    s += f", v_rfdc"
+    return s
+
+
 class Generator():
     def __init__(self):
         log_dir = './log'
@@ -49,11 +84,7 @@ class Generator():
                             datefmt='%y-%m-%d %H:%M:%S',
                             level=logging.INFO)
         logging.StreamHandler.terminator = ""
-        s = "rx#, R, θ, φ"
-        for i in range(esa.tx_num):
-            s += f", ps#{i}"
-        s += f", v_rfdc"
-        logging.info(f"{s}\n")
+        logging.info(f"{get_header()}\n")
         self.num_cases = 0
 
     def add_line(self, r, theta_d, phi_d):
@@ -62,7 +93,7 @@ class Generator():
         phases /= phase_step
         phases = phases.astype(int)
         power = predict_power(r + randint(-5, 5)) + randint(-10, 10)
-        for v in phases.flatten():
+        for v in esa.layout.to_hw(phases):
             v = (v + randint(-4, 3)) % ps_code_limit
             s += f", {v}"
         s += f", {power:.0f}"
@@ -70,12 +101,65 @@ class Generator():
         self.num_cases += 1
 
 
+""" Bulk generation
+same distribution as Generator.add_line, but whole arrays at once
+"""
+def generate_rows(cases, seed=None):
+    """ cases (P, 3) of (r, θ, φ) -> rows (P, 4 + tx_num + 1) in the csv layout
+    """
+    rng = np.random.default_rng(seed)
+    r, theta_d, phi_d = cases.T
+    codes = esa.layout.to_hw((esa.get_desired_phase(theta_d, phi_d) / phase_step).astype(int))
+    codes = (codes + rng.integers(-4, 4, codes.shape)) % ps_code_limit
+    power = predict_power(r + rng.integers(-5, 6, len(r))) + rng.integers(-10, 11, len(r))
+    return np.column_stack([np.ones(len(cases)), np.rint(cases), codes, np.rint(power)]).astype(np.int32)
+
+
+def _generate_chunk(args):
+    return generate_rows(*args)
+
+
+def generate_bulk(path, cases=None, seed=0, chunk_size=100_000, workers=1):
+    """ Write rows chunk by chunk to .csv or .npy (memory-mapped)
+    every chunk has its own seed, so the output doesn't depend on the number of workers
+    """
+    if cases is None:
+        cases = get_position_grid(r=(50, 500, 50), theta_d=(0, 45, 5), phi_d=(180, 360, 5))
+    chunks = [cases[i:i + chunk_size] for i in range(0, len(cases), chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    jobs = list(zip(chunks, seeds))
+    ncols = 4 + esa.tx_num + 1
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_generate_chunk, jobs)
+    else:
+        executor = None
+        results = map(_generate_chunk, jobs)
+
+    try:
+        if path.endswith('.npy'):
+            out = np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=(len(cases), ncols))
+            o = 0
+            for rows in results:
+                out[o:o + len(rows)] = rows
+                o += len(rows)
+            out.flush()
+        else:
+            fmt = ", ".join(["%d"] * ncols)
+            with open(path, 'w') as f:
+                f.write(f"{get_header()}\n")
+                for rows in results:
+                    np.savetxt(f, rows, fmt=fmt)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return len(cases)
+
+
 if __name__ == "__main__":
-    gen = Generator()
-    for r in range(50, 500 + 1, 50):
-        for theta_d in range(0, 45 + 1, 5):
-            for phi_d in range(180, 360 + 1, 5):
-                if theta_d == 0: phi_d = 0
-                gen.add_line(r, theta_d, phi_d)
-                if theta_d == 0: break
-    print(f"\nNumber of total cases: {gen.num_cases}")
\ No newline at end of file
+    log_dir = './log'
+    os.makedirs(log_dir, exist_ok=True)
+    path = f"{log_dir}/{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    num_cases = generate_bulk(path, workers=os.cpu_count())
+    print(f"\nNumber of total cases: {num_cases}")
@@ -8,7 +8,6 @@ from functools import partial
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import *
 from PyQt6.QtCore import *
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
 from main import Status, Command, Backend
 from sim import Esa, receivers
@@ -25,7 +24,41 @@ phase_step = 360 / (1 << ps_n_bits)
 ps_code_limit = 1 << ps_n_bits
 
 backend = Backend(tx_num=esa.tx_num, peri_num=5)
-phases = np.zeros(esa.tx_num, dtype=np.int8)
+phases = np.zeros(esa.tx_num, dtype=np.int8)  # GUI thread only, the backend gets copies
+
+
+class Bridge(QObject):
+    """ Backend notifications as Qt signals, delivered in the GUI thread
+    """
+    status_changed = pyqtSignal(int)
+    edge = pyqtSignal(int, int)
+    dnstrm_changed = pyqtSignal()
+    pacer_changed = pyqtSignal(dict)
+    tx_changed = pyqtSignal()  # GUI side phases
+
+    def __init__(self):
+        super().__init__()
+        self.dnstrm_pending = False  # coalesce packets while the GUI is behind
+
+    def relay(self, event, *args):
+        try:
+            match event:
+                case 'status':
+                    self.status_changed.emit(*args)
+                case 'edge':
+                    self.edge.emit(*args)
+                case 'dnstrm':
+                    if not self.dnstrm_pending:
+                        self.dnstrm_pending = True
+                        self.dnstrm_changed.emit()
+                case 'pacer':
+                    self.pacer_changed.emit(*args)
+        except RuntimeError:  # deleted at exit while the backend thread still runs
+            pass
+
+
+bridge = Bridge()
+backend.add_listener(bridge.relay)
 
 
 def resource_path(relpath):
@@ -36,50 +69,27 @@ def resource_path(relpath):
     return os.path.abspath(os.path.join(cwd, relpath))
 
 
-class Coord():
-    @staticmethod
-    def get_1d_index(m, n):
-        return esa.M * n + m
-
-    @staticmethod
-    def get_2d_index(i):
-        m = i % esa.M
-        n = i // esa.M
-        return m, n
-
-
 def process_phases(_phases):
-    sim_phases = np.ndarray((esa.N, esa.M), dtype=float)
-    for i in range(esa.tx_num):
-        m, n = Coord.get_2d_index(i)
-        m, n = esa.M - m - 1, esa.N - n - 1  # FIXME: y=x symmetry
-        sim_phases[n][m] = max(0, _phases[i] * phase_step)
-    return sim_phases
+    return np.maximum(0, esa.layout.to_sim(_phases) * phase_step)
 
 
-def get_phase_display_string(arr1d=None, string=""):
+def get_phase_display_string(arr1d=None):
     if arr1d is None:
         arr1d = phases
-    for n in range(esa.N):
-        string += "\n" if n > 0 else ""
-        for m in range(esa.M):
-            string += " " if m > 0 else ""
-            code = arr1d[Coord.get_1d_index(m, n)]
-            string += f"{code:2d}"
-    return string
+    return "\n".join(" ".join(f"{code:2d}" for code in row) for row in esa.layout.to_panel(arr1d))
 
 
 def update_receivers():
+    rx_infos = backend.rx_infos
     for i, receiver in enumerate(receivers):
-        peri_info = backend.rx_infos[i]
+        peri_info = rx_infos[i]
         if all(peri_info.address == 0):
             receiver.r = 0
-            peri_info.theta_d = 0
-            peri_info.phi_d = 0
+            backend.set_rx_coord(i, 0, 0, 0)
             continue
-        v = esa.get_vector(process_phases(peri_info.phases))
-        receiver.set_spherical_coord(200, v.theta, v.phi)
-        peri_info.set_spherical_coord(0, v.theta, v.phi)
+        theta_d, phi_d, _ = esa.codebook.lookup(process_phases(peri_info.phases))
+        receiver.set_spherical_coord(200, theta_d, phi_d)
+        backend.set_rx_coord(i, 0, theta_d, phi_d)
 
 
 class Window(QMainWindow):
@@ -107,29 +117,33 @@ class Window(QMainWindow):
         self.setCentralWidget(self.widget)
         QShortcut(QKeySequence('Ctrl+Q'), self, self.close)
         QShortcut(QKeySequence('Ctrl+W'), self, self.close)
+        QShortcut(QKeySequence('v'), self, esa.toggle_view)  # 3D surface <-> principal cuts
 
         # for debug
         QShortcut(QKeySequence('p'), self, lambda: print(phases))
 
         self.statusbar = self.statusBar()
+        self.pacer_label = QLabel()
+        self.statusbar.addPermanentWidget(self.pacer_label)
+
+        bridge.status_changed.connect(self.on_status)
+        bridge.edge.connect(self.on_edge)
+        bridge.dnstrm_changed.connect(self.on_dnstrm)
+        bridge.pacer_changed.connect(self.on_pacer)
+        self.on_status(backend.status)
 
         streamer = threading.Thread(target=backend.process)
         streamer.daemon = True
         streamer.start()
-
-        timer = QTimer(self)
-        timer.timeout.connect(self.updater)
-        timer.start(10)
         self.show()
 
-    def updater(self):
-        if backend.status == Status.READY:
+    def on_status(self, status):
+        if status == Status.READY:
             backend.upstrm.phases = phases.copy()
             self.widget.tx_group.setEnabled(True)
             self.widget.rx_group.setEnabled(True)
             self.widget.cmd_group.setEnabled(True)
-        elif backend.status == Status.BUSY:
-            phases.put(range(0, esa.tx_num), backend.dnstrm.curr_phases)
+        elif status == Status.BUSY:
             self.widget.tx_group.setEnabled(False)
             self.widget.rx_group.setEnabled(True)
             self.widget.cmd_group.setEnabled(False)
@@ -137,33 +151,47 @@ class Window(QMainWindow):
             self.widget.tx_group.setEnabled(False)
             self.widget.rx_group.setEnabled(False)
             self.widget.cmd_group.setEnabled(False)
-        self.statusbar.showMessage(Status(backend.status).name.lower())
+        self.statusbar.showMessage(Status(status).name.lower())
         self.setStyleSheet(self.ss_by_status())
 
+    def on_pacer(self, stats):
+        self.pacer_label.setText(f"{stats['mode']}  {stats['rate']:.0f} pkt/s  "
+                                 f"jitter {stats['jitter_ms']:.2f}ms  cpu {stats['cpu']:.0f}%")
+
+    def on_dnstrm(self):
+        bridge.dnstrm_pending = False
+        dn = backend.dnstrm
+        if backend.status == Status.BUSY and any(phases != dn.curr_phases):
+            phases.put(range(0, esa.tx_num), dn.curr_phases)
+            bridge.tx_changed.emit()
+        update_receivers()
+        self.widget.rx_refresh()
+
+    def on_edge(self, cmd, direction):
         """ Backend signal manager
         """
-        if backend.gui_sigdir == 1:  # Rising Edge
+        if direction == 1:  # Rising Edge
             self.start_time = datetime.now()
-            match backend.gui_signal:
+            match cmd:
                 case Command.SCAN:
                     self.print("Scanning... ")
-        elif backend.gui_sigdir == -1:  # Falling Edge
+        elif direction == -1:  # Falling Edge
             td = datetime.now() - self.start_time
             td = td - timedelta(microseconds=td.microseconds)
-            match backend.gui_signal:
+            match cmd:
                 case Command.RESET:
                     self.print("Reset whole phases\n")
                 case Command.SCAN:
                     self.print(f"Done ({td})\n")
                 case Command.STEER:
                     self.print(f"Steering to Rx#{backend.upstrm.target + 1}\n")
-            update_receivers()
             fault_index = np.argwhere(backend.dnstrm.pa_powers < 250)
             if len(fault_index):
                 self.print(f"\n[Warning] Below PAs signal is invalid.\n{fault_index.flatten()}\n")
             self.scroll_to_bottom()
             backend.gui_signal = Command.NOP
         backend.gui_sigdir = 0
+        self.widget.rx_refresh()
 
     def print(self, *args, **kwargs):
         # self.widget.te.append(*args, **kwargs)
@@ -177,6 +205,7 @@ class Widget(QWidget):
     def __init__(self):
         super().__init__()
         self.dn_loss_prev = 255
+        self.shown = dict()
         self.normal_ss = 'background-color: ghostwhite;'
         self.setStyleSheet(self.normal_ss)
         self.init_ui()
@@ -195,6 +224,14 @@ class Widget(QWidget):
         grid.addWidget(self.create_canvas(), 0, 0, 3, 1)
         grid.addWidget(self.create_console(), 2, 1, 1, 2)
 
+    def refresh(self, widget, setter, value, *args):
+        """ Call the setter only when the shown value differs
+        """
+        key = (id(widget), setter)
+        if self.shown.get(key) != value:
+            self.shown[key] = value
+            getattr(widget, setter)(*(args or (value,)))
+
     def style_groupbox(self, groupbox):
         groupbox_font = QFont()
         groupbox_font.setPointSize(15)
@@ -204,6 +241,7 @@ class Widget(QWidget):
         groupbox.setStyleSheet(groupbox_ss)
 
     def create_canvas(self):
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
         fig = esa.plot()
         canvas = FigureCanvas(fig)
         canvas.draw()
@@ -315,7 +353,7 @@ class Widget(QWidget):
         phase_dials = np.ndarray((esa.N, esa.M), dtype='O')
         phase_labels = np.ndarray((esa.N, esa.M), dtype='O')
         def create_single_phase_layout(m, n):
-            idx = Coord.get_1d_index(m, n)
+            idx = esa.layout.hw_index[n, m]
             _groupbox = QGroupBox(f"Tx {idx}")
             _groupbox.setFlat(True)
             if esa.M > 4:
@@ -342,7 +380,10 @@ class Widget(QWidget):
                 if dial.value() == ps_code_limit:
                     dial.setValue(0)
                 phases.put(idx, dial.value())
+                if backend.status == Status.READY:
+                    backend.upstrm.phases = phases.copy()
                 backend.set_cmd(Command.SET_PHASE)
+                bridge.tx_changed.emit()
             dial.valueChanged.connect(dial_changed)
             dial_changed()
 
@@ -352,20 +393,29 @@ class Widget(QWidget):
             for m in range(esa.M):
                 grid.addWidget(create_single_phase_layout(m, n), n + 1, m + 1)
 
-        def tx_system_updater():
-            for n in range(esa.N):
-                for m in range(esa.M):
-                    val = phases[Coord.get_1d_index(m, n)]
-                    phase_dials[n][m].setValue(val)
-                    phase_labels[n][m].setText(f"{val:2}")
-            esa.set_phases(process_phases(phases))
-
-            if backend.dnstrm.loss != self.dn_loss_prev:
-                dsa_slider.setValue(-backend.dnstrm.loss)
-            self.dn_loss_prev = backend.dnstrm.loss
-        timer = QTimer(self)
-        timer.timeout.connect(tx_system_updater)
-        timer.start(100)
+        shown = np.full(esa.tx_num, -1)
+        def tx_refresh():
+            changed = np.flatnonzero(phases != shown)
+            for i in changed:
+                n, m = esa.layout.hw_position(i)
+                val = int(phases[i])
+                dial = phase_dials[n][m]
+                dial.blockSignals(True)
+                dial.setValue(val)
+                dial.blockSignals(False)
+                phase_labels[n][m].setText(f"{val:2}")
+            shown[:] = phases
+            if len(changed):
+                esa.set_phases(process_phases(phases))
+        bridge.tx_changed.connect(tx_refresh)
+        tx_refresh()
+
+        def loss_refresh():
+            loss = backend.dnstrm.loss
+            if loss != self.dn_loss_prev:
+                dsa_slider.setValue(-loss)
+            self.dn_loss_prev = loss
+        bridge.dnstrm_changed.connect(loss_refresh)
 
         return groupbox
 
@@ -469,7 +519,7 @@ class Widget(QWidget):
                     return i
             return len(levels)
 
-        def rx_updater():
+        def rx_refresh():
             bat_adc_min, bat_adc_max = 2150, 3600
             for i, rx in enumerate(backend.rx_infos):
                 w = rx_widgets[i]
@@ -478,29 +528,30 @@ class Widget(QWidget):
                 bat_pct = int((bat_adc - bat_adc_min) / (bat_adc_max - bat_adc_min) * 100)
 
                 addr = ':'.join(f"{x:02X}" for x in rx.address[:3])
-                w['tag'].setText(f"Rx #{i + 1}\n({addr})")
+                self.refresh(w['tag'], 'setText', f"Rx #{i + 1}\n({addr})")
 
                 if all(rx.address == 0):
-                    w['tag'].setStyleSheet("background-color: darkcyan")
+                    ss = "background-color: darkcyan"
                 elif backend.gui_signal == Command.SCAN:
-                    w['tag'].setStyleSheet("background-color: yellow")
+                    ss = "background-color: yellow"
                 elif all(backend.upstrm.phases == rx.phases):
-                    w['tag'].setStyleSheet("background-color: yellow")
+                    ss = "background-color: yellow"
                 else:
-                    w['tag'].setStyleSheet(self.normal_ss)
-
-                w['rfdc_img'].setPixmap(pixmaps[level])
-                w['rfdc_label'].setText(f"{rx.rfdc_adc}")
-                w['bat_pbar'].setValue(bat_pct)
-                w['bat_label'].setText(f"{rx.bat_adc}")
-                w['profile_label'].setText(get_phase_display_string(rx.phases))
-                w['vector']['r'].setText("N/A")  # TODO: replace with RSSI
-                w['vector']['theta'].setText(f"{rx.theta_d:.0f}")
-                w['vector']['phi'].setText(f"{rx.phi_d:.0f}")
-
-        timer = QTimer(self)
-        timer.timeout.connect(rx_updater)
-        timer.start(100)
+                    ss = self.normal_ss
+                self.refresh(w['tag'], 'setStyleSheet', ss)
+
+                self.refresh(w['rfdc_img'], 'setPixmap', level, pixmaps[level])
+                self.refresh(w['rfdc_label'], 'setText', f"{rx.rfdc_adc}")
+                self.refresh(w['bat_pbar'], 'setValue', bat_pct)
+                self.refresh(w['bat_label'], 'setText', f"{rx.bat_adc}")
+                self.refresh(w['profile_label'], 'setText', get_phase_display_string(rx.phases))
+                self.refresh(w['vector']['r'], 'setText', "N/A")  # TODO: replace with RSSI
+                _, theta_d, phi_d = backend.rx_coords[i]
+                self.refresh(w['vector']['theta'], 'setText', f"{theta_d:.0f}")
+                self.refresh(w['vector']['phi'], 'setText', f"{phi_d:.0f}")
+        self.rx_refresh = rx_refresh
+        bridge.tx_changed.connect(rx_refresh)
+        rx_refresh()
 
         return groupbox
 
@@ -0,0 +1,140 @@
+import numpy as np
+
+""" Telemetry history
+every received packet is pushed as one row of channels into preallocated rings:
+the raw ring keeps the last `depth` packets, and every resolution level keeps `depth`
+(min, max, mean) buckets of that many seconds, so memory is fixed for any session length.
+Written by the backend thread only; readers get copies, the oldest rows may be overwritten
+while a long read is in progress.
+"""
+
+CHANNELS = ('rfdc_adc', 'bat_adc', 'v_rfdc_scan', 'pa_powers')
+
+
+class Ring():
+    def __init__(self, depth, width, dtype=np.float32):
+        self.depth = depth
+        self.t = np.zeros(depth)
+        self.data = np.zeros((depth, width), dtype=dtype)
+        self.count = 0  # total rows ever written
+
+    def push(self, t, row):
+        i = self.count % self.depth
+        self.t[i] = t
+        self.data[i] = row
+        self.count += 1
+
+    def get(self, since=None):
+        """ chronological (t, rows) copies
+        """
+        count = self.count
+        n = min(count, self.depth)
+        idx = np.arange(count - n, count) % self.depth
+        t, data = self.t[idx], self.data[idx]
+        if since is not None:
+            keep = t >= since
+            t, data = t[keep], data[keep]
+        return t, data
+
+
+class Level():
+    """ downsampled ring, one (min, max, mean) bucket per `resolution` seconds
+    """
+    def __init__(self, depth, width, resolution):
+        self.resolution = resolution
+        self.ring = Ring(depth, 3 * width)
+        self.width = width
+        self.bucket = None
+        self.lo = np.full(width, np.inf)
+        self.hi = np.full(width, -np.inf)
+        self.sum = np.zeros(width)
+        self.num = 0
+
+    def push(self, t, row):
+        bucket = int(t // self.resolution)
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        np.minimum(self.lo, row, out=self.lo)
+        np.maximum(self.hi, row, out=self.hi)
+        self.sum += row
+        self.num += 1
+
+    def flush(self):
+        if self.num:
+            self.ring.push(self.bucket * self.resolution, np.concatenate([self.lo, self.hi, self.sum / self.num]))
+        self.lo.fill(np.inf)
+        self.hi.fill(-np.inf)
+        self.sum.fill(0)
+        self.num = 0
+
+    def get(self, since=None):
+        """ buckets are stamped with their start, those still open at `since` are included
+        """
+        t, data = self.ring.get()
+        if since is not None:
+            keep = t + self.resolution > since
+            t, data = t[keep], data[keep]
+        lo, hi, mean = np.split(data, 3, axis=1)
+        if self.num and (since is None or (self.bucket + 1) * self.resolution > since):  # the open bucket
+            t = np.append(t, self.bucket * self.resolution)
+            lo = np.vstack([lo, self.lo])
+            hi = np.vstack([hi, self.hi])
+            mean = np.vstack([mean, self.sum / self.num])
+        return t, lo, hi, mean
+
+
+class History():
+    def __init__(self, peri_num, tx_num, depth=4096, resolutions=(1, 10, 60)):
+        widths = (peri_num, peri_num, peri_num, tx_num)
+        self.slices = {}
+        offset = 0
+        for name, width in zip(CHANNELS, widths):
+            self.slices[name] = slice(offset, offset + width)
+            offset += width
+        self.row = np.zeros(offset, dtype=np.float32)
+        self.row_seq = None  # the row is rebuilt only when a new Downstream arrives
+        self.raw = Ring(depth, offset)
+        self.levels = {res: Level(depth, offset, res) for res in resolutions}
+
+    @property
+    def nbytes(self):
+        return self.raw.data.nbytes + sum(level.ring.data.nbytes for level in self.levels.values())
+
+    def push(self, t, dn):
+        """ t: monotonic seconds, dn: main.Downstream
+        """
+        row = self.row
+        if dn.seq != self.row_seq:
+            self.row_seq = dn.seq
+            for i, info in enumerate(dn.peri_infos):
+                row[self.slices['rfdc_adc']][i] = info.rfdc_adc
+                row[self.slices['bat_adc']][i] = info.bat_adc
+                row[self.slices['v_rfdc_scan']][i] = info.v_rfdc_scan
+            row[self.slices['pa_powers']] = dn.pa_powers
+        self.raw.push(t, row)
+        for level in self.levels.values():
+            level.push(t, row)
+
+    def get(self, channel, index=None, resolution=None, since=None):
+        """ channel: one of CHANNELS, index: peripheral or PA, None for all
+        raw: returns (t, values), resolution in seconds: returns (t, min, max, mean)
+        """
+        sl = self.slices[channel]
+        cols = sl if index is None else sl.start + index
+        if resolution is None:
+            t, data = self.raw.get(since)
+            return t, data[:, cols]
+        t, *stats = self.levels[resolution].get(since)
+        return (t, *(s[:, cols] for s in stats))
+
+    def get_faults(self, resolution, channel='pa_powers', low=None, high=None, since=None):
+        """ indices whose bucket minimum fell below `low` or maximum exceeded `high`
+        """
+        _, lo, hi, _ = self.get(channel, resolution=resolution, since=since)
+        fault = np.zeros(lo.shape[1], dtype=bool)
+        if low is not None:
+            fault |= (lo < low).any(axis=0)
+        if high is not None:
+            fault |= (hi > high).any(axis=0)
+        return np.flatnonzero(fault)
@@ -0,0 +1,200 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+""" Compute backends for the Esa kernels
+pattern: |S @ x| for a (G, K) steering matrix and (K,) or (K, B) weighted phasors
+peak: argmax of the pattern over G and its magnitude
+desired_phase: conjugate steering phase in [0, 360) for (D, 3) direction cosines
+
+'numpy' is the reference, 'threaded' splits G (or D) over a thread pool, NumPy releases
+the GIL inside the products, 'numba' is JIT compiled and used only if numba is installed.
+Select with use(name) or the ESA_KERNELS environment variable.
+"""
+
+
+class NumpyKernels():
+    name = 'numpy'
+
+    def pattern(self, S, x):
+        return np.abs(S @ x)
+
+    def peak(self, S, x):
+        r = self.pattern(S, x)
+        i = np.argmax(r, axis=0)
+        if r.ndim == 1:
+            return i, r[i]
+        return i, r[i, np.arange(r.shape[1])]
+
+    def desired_phase(self, kxyz, uvw):
+        """ kxyz: (K, 3) element positions times the wavenumber, uvw: (D, 3), returns (D, K) degrees
+        """
+        phase_d = np.angle(np.exp(-1j * (uvw @ kxyz.T)), deg=True)
+        phase_d[phase_d < 0] += 360
+        return phase_d
+
+
+# shared by every ThreadedKernels instance, threads start on first use
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='kernels')
+
+
+class ThreadedKernels(NumpyKernels):
+    name = 'threaded'
+    min_size = 1 << 16  # elements of work below which threads don't pay off
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.executor = _executor
+
+    def split(self, n, size, func):
+        if size < self.min_size or self.workers == 1:
+            return func(slice(0, n))
+        chunk = -(-n // self.workers)
+        return np.concatenate(list(self.executor.map(func, [slice(o, o + chunk) for o in range(0, n, chunk)])))
+
+    def pattern(self, S, x):
+        return self.split(len(S), S.size * (1 if x.ndim == 1 else x.shape[1]), lambda s: np.abs(S[s] @ x))
+
+    def desired_phase(self, kxyz, uvw):
+        parent = super()
+        return self.split(len(uvw), len(uvw) * len(kxyz), lambda s: parent.desired_phase(kxyz, uvw[s]))
+
+
+class NumbaKernels(NumpyKernels):
+    name = 'numba'
+
+    def __init__(self):
+        import math
+        from numba import njit, prange
+
+        @njit(parallel=True, fastmath=True, cache=True)
+        def pattern(S, x):
+            G, K = S.shape
+            B = x.shape[1]
+            out = np.empty((G, B))
+            for g in prange(G):
+                for b in range(B):
+                    acc = 0j
+                    for i in range(K):
+                        acc += S[g, i] * x[i, b]
+                    out[g, b] = abs(acc)
+            return out
+
+        @njit(parallel=True, cache=True)
+        def desired_phase(kxyz, uvw):
+            D, K = uvw.shape[0], kxyz.shape[0]
+            out = np.empty((D, K))
+            for d in prange(D):
+                for i in range(K):
+                    p = -(uvw[d, 0] * kxyz[i, 0] + uvw[d, 1] * kxyz[i, 1] + uvw[d, 2] * kxyz[i, 2])
+                    deg = math.degrees(math.atan2(math.sin(p), math.cos(p)))
+                    out[d, i] = deg + 360 if deg < 0 else deg
+            return out
+
+        self._pattern = pattern
+        self._desired_phase = desired_phase
+
+    def pattern(self, S, x):
+        S = np.ascontiguousarray(S, dtype=complex)
+        x = np.asarray(x, dtype=complex)
+        r = self._pattern(S, x.reshape(len(x), -1))
+        return r[:, 0] if x.ndim == 1 else r
+
+    def desired_phase(self, kxyz, uvw):
+        return self._desired_phase(np.ascontiguousarray(kxyz, dtype=float), np.ascontiguousarray(uvw, dtype=float))
+
+
+BACKENDS = {
+    'numpy': NumpyKernels,
+    'threaded': ThreadedKernels,
+    'numba': NumbaKernels,
+}
+
+
+def available():
+    names = ['numpy', 'threaded']
+    try:
+        import numba  # noqa: F401
+        names.append('numba')
+    except ImportError:
+        pass
+    return names
+
+
+_active = None
+
+
+def get():
+    global _active
+    if _active is None:
+        name = os.environ.get('ESA_KERNELS', 'numpy')
+        if name not in available():
+            print(f"ESA_KERNELS={name} is not available, numpy is used")
+            name = 'numpy'
+        use(name, check_first=name != 'numpy')
+    return _active
+
+
+def use(name, check_first=True):
+    """ switch the active backend, non-reference backends are checked against numpy first
+    """
+    global _active
+    kernels = BACKENDS[name]()
+    if check_first:
+        check(kernels)
+    _active = kernels
+    return kernels
+
+
+def check(kernels, K=64, G=500, D=200, B=3, seed=0):
+    """ shared correctness test against the numpy reference
+    """
+    rng = np.random.default_rng(seed)
+    ref = NumpyKernels()
+    S = np.exp(1j * rng.uniform(-np.pi, np.pi, (G, K)))
+    x = rng.uniform(1, 8, (K, B)) * np.exp(1j * rng.uniform(-np.pi, np.pi, (K, B)))
+    kxyz = rng.uniform(-20, 20, (K, 3))
+    uvw = rng.uniform(-1, 1, (D, 3))
+
+    assert np.allclose(kernels.pattern(S, x), ref.pattern(S, x)), f"{kernels.name}: pattern"
+    assert np.allclose(kernels.pattern(S, x[:, 0]), ref.pattern(S, x[:, 0])), f"{kernels.name}: pattern 1D"
+    i, r = kernels.peak(S, x)
+    i_ref, r_ref = ref.peak(S, x)
+    assert np.array_equal(i, i_ref) and np.allclose(r, r_ref), f"{kernels.name}: peak"
+    # compare on the circle, 0 and 360 are the same phase
+    diff = kernels.desired_phase(kxyz, uvw) - ref.desired_phase(kxyz, uvw)
+    assert np.allclose((diff + 180) % 360 - 180, 0, atol=1e-6), f"{kernels.name}: desired phase"
+
+
+def benchmark(names=None, sizes=((4, 4), (8, 8), (16, 16)), repeat=20):
+    """ ms per call of every kernel, on the Esa plotting grid and a 1° x 5° direction grid
+    """
+    from sim import Esa, THETA, PHI, DEGREE_STEP
+
+    names = names or available()
+    print(f"{'backend':>9} {'array':>6} {'pattern(ms)':>12} {'desired phase(ms)':>18} {'peak(ms)':>9}")
+    for M, N in sizes:
+        esa = Esa(M, N)
+        S = esa.get_steering_matrix(THETA, PHI).reshape(-1, esa.tx_num)
+        x = (esa.weights * np.exp(1j * np.deg2rad(esa.get_desired_phase(30, 120)))).ravel()
+        theta_r, phi_r = np.deg2rad(np.meshgrid(np.arange(0, 90 + 1, DEGREE_STEP / 5), np.arange(0, 360, DEGREE_STEP)))
+        uvw = np.stack([np.sin(theta_r) * np.cos(phi_r), np.sin(theta_r) * np.sin(phi_r), np.cos(theta_r)], axis=-1).reshape(-1, 3)
+        for name in names:
+            kernels = BACKENDS[name]()
+            check(kernels)
+            row = []
+            for func, args in [(kernels.pattern, (S, x)), (kernels.desired_phase, (esa.kxyz, uvw)), (kernels.peak, (S, x))]:
+                func(*args)
+                t = time.perf_counter()
+                for _ in range(repeat):
+                    func(*args)
+                row.append((time.perf_counter() - t) / repeat * 1000)
+            print(f"{name:>9} {f'{M}x{N}':>6} {row[0]:12.3f} {row[1]:18.3f} {row[2]:9.3f}")
+
+
+if __name__ == "__main__":
+    for name in available():
+        check(BACKENDS[name]())
+        print(f"{name}: ok")
+    benchmark()
@@ -1,12 +1,18 @@
 #!/usr/bin/python3
 import os
+import time
+import atexit
+import queue
 import socket
 import logging
 import random
+import threading
 import numpy as np
 from datetime import datetime
 from enum import IntEnum, auto
 from colorama import Fore
+from scheduler import get_position_grid
+from history import History
 
 
 class Param():
@@ -63,44 +69,44 @@ class Upstream():
         return data.tobytes()
 
 
+class PeriInfo():
+    def __init__(self, data):
+        self.address = np.frombuffer(data, dtype=np.uint8, count=6, offset=0)
+        self.connected = False
+        self.rfdc_adc, self.bat_adc, self.v_rfdc_scan = map(int, np.frombuffer(data, dtype=np.uint16, count=3, offset=8))
+        self.phases = np.frombuffer(data, dtype=np.int8, count=Param.tx_num, offset=16)
+
+
 class Downstream():
-    def __init__(self):
-        self.cmd_fired = Command.NOP
-        self.loss = 127
-        self.curr_phases = np.zeros(Param.tx_num, dtype=np.int8)
-        self.pa_powers = np.zeros(Param.tx_num, dtype=np.uint16)
-
-        class PeriInfo(object):
-            def __init__(self):
-                self.address = np.zeros(6, dtype=np.uint8)
-                self.connected = False
-                self.rfdc_adc, self.bat_adc = 0, 0
-                self.v_rfdc_scan = 0
-                self.phases = np.zeros(Param.tx_num, dtype=np.int8)
-                self.r, self.theta_d, self.phi_d = 0, 0, 0
-            def set_spherical_coord(self, r, theta_d, phi_d):
-                self.r, self.theta_d, self.phi_d = r, theta_d, phi_d
-        self.peri_infos = [PeriInfo() for _ in range(Param.peri_num)]
-
-    def unpack_data(self, data):
+    """ Telemetry snapshot of a single packet
+    Never modified after construction, arrays are read-only views into the packet bytes.
+    The backend publishes a new one by swapping the reference, so a reader that takes
+    `dn = backend.dnstrm` once gets a consistent frame without locks or copies.
+    """
+    def __init__(self, data=None, seq=0):
+        if data is None:
+            data = np.zeros(256 + 128 * Param.peri_num, dtype=np.uint8)
+            data[1] = 127  # loss
+            data = data.tobytes()
+        self.raw = data
+        self.seq = seq
         self.cmd_fired = data[0]
         self.loss = data[1]
         self.curr_phases = np.frombuffer(data, dtype=np.int8, count=Param.tx_num, offset=64)
         self.pa_powers = np.frombuffer(data, dtype=np.uint16, count=Param.tx_num, offset=128)
-        o = 256
-        for p in self.peri_infos:
-            p.address = np.frombuffer(data[o:], dtype=np.uint8, count=6, offset=0)
-            p.rfdc_adc, p.bat_adc, p.v_rfdc_scan = np.frombuffer(data[o:], dtype=np.uint16, count=3, offset=8)
-            p.phases = np.frombuffer(data[o:], dtype=np.int8, count=Param.tx_num, offset=16)
-            o += 128
+        self.peri_infos = tuple(PeriInfo(data[256 + 128 * i:256 + 128 * (i + 1)]) for i in range(Param.peri_num))
 
 
 class Logger():
-    def __init__(self):
-        log_dir = './log'
-        os.makedirs(log_dir, exist_ok=True)
-        logging.basicConfig(filename=f"{log_dir}/{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                            filemode='w',
+    def open_log(self, path=None, append=False):
+        """ append: continue an existing file (resumed campaign), the header is written only to a new or empty file
+        """
+        if path is None:
+            path = f"./log/{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        append = append and os.path.exists(path) and os.path.getsize(path) > 0
+        logging.basicConfig(filename=path,
+                            filemode='a' if append else 'w',
                             # format='%(asctime)s, %(message)s',
                             format='%(message)s',
                             datefmt='%y-%m-%d %H:%M:%S',
@@ -112,7 +118,67 @@ class Logger():
             s += f", ps#{i}"
         s += f", v_rfdc"
         # s += ", CCP(uW), Scanning Rate(ms), TOPS/W"
-        logging.info(f"{s}\n")
+        if not append:
+            logging.info(f"{s}\n")
+
+        """ Background writer
+        records are queued by the exchange loop and written in batches,
+        so disk stalls never reach the packet exchange
+        """
+        self.log_queue = queue.Queue(maxsize=1024)
+        self.log_batch_size = 64
+        self.log_flush_interval = 1.0  # sec
+        self.log_drops = 0
+        self.log_backpressure = 0
+        self.log_stop = threading.Event()
+        self.log_writer = threading.Thread(target=self.write_log, daemon=True)
+        self.log_writer.start()
+        atexit.register(self.close_log)
+
+    def log(self, s, done=None):
+        """ Non-blocking. Drops the record if the writer can't keep up
+        done: positions finished with this record, checkpointed once it is written
+        """
+        if self.log_queue.qsize() > self.log_queue.maxsize // 2:
+            self.log_backpressure += 1
+        try:
+            self.log_queue.put_nowait((s, done))
+        except queue.Full:
+            self.log_drops += 1
+
+    def write_log(self):
+        batch = []
+        deadline = time.monotonic() + self.log_flush_interval
+        while not (self.log_stop.is_set() and self.log_queue.empty()):
+            try:
+                batch.append(self.log_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.log_batch_size or time.monotonic() >= deadline:
+                self.write_batch(batch)
+                deadline = time.monotonic() + self.log_flush_interval
+        self.write_batch(batch)
+
+    def write_batch(self, batch):
+        """ The checkpoint trails the data, it moves only after the records are written
+        """
+        if not batch:
+            return
+        logging.info("".join(s for s, _ in batch))
+        done = [d for _, d in batch if d is not None]
+        if done:
+            self.checkpoint(max(done))
+        batch.clear()
+
+    def close_log(self):
+        """ Flush pending records and stop the writer
+        """
+        if not hasattr(self, 'log_stop') or self.log_stop.is_set():
+            return
+        self.log_stop.set()
+        self.log_writer.join()
+        if self.log_drops or self.log_backpressure:
+            print(f"{Fore.YELLOW}log drops: {self.log_drops} / backpressure: {self.log_backpressure}{Fore.RESET}")
 
     def get_csv_string(self):
         assert hasattr(self, 'rx_infos')  # NOTE: from Backend
@@ -127,7 +193,8 @@ class Logger():
             if self.pos_idx < self.end:  # during equipment control
                 s += f"{i + 1}, {self.curr_pos[0]:.0f}, {self.curr_pos[1]:.0f}, {self.curr_pos[2]:.0f}"
             else:  # normal case
-                s += f"{i + 1}, {rx.r:.0f}, {rx.theta_d:.0f}, {rx.phi_d:.0f}"
+                r, theta_d, phi_d = self.rx_coords[i]
+                s += f"{i + 1}, {r:.0f}, {theta_d:.0f}, {phi_d:.0f}"
 
             for v in rx.phases:
                 s += f", {v}"
@@ -144,8 +211,13 @@ class Logger():
 
 
 class EquipCtrl():
-    def __init__(self, start, end):
-        self.positions = self.get_position_array_1d()
+    def __init__(self, start, end, scheduler=None):
+        self.scheduler = scheduler
+        if scheduler is None:
+            self.positions = self.get_position_array_1d()
+        else:
+            self.positions = scheduler.positions
+            start = max(start, scheduler.done)
         self.start, self.end = max(start, 0), min(end, len(self.positions))
         self.pos_idx = self.start
         self.pos_idx_prev = -1
@@ -154,35 +226,133 @@ class EquipCtrl():
     def curr_pos(self):
         return self.positions[self.pos_idx]
 
+    def next_pos(self):
+        self.pos_idx += 1
+
+    def checkpoint(self, done):
+        """ Called from the log writer thread, never from the exchange loop
+        """
+        if self.scheduler is not None:
+            self.scheduler.save(done)
+
     @staticmethod
     def get_position_array_1d():
-        ret = []
-        R = range(50, 300 + 1, 100)
-        THETA_D = range(0, 45 + 1, 10)
-        PHI_D = range(180, 360 + 1, 60)
-        for r in R:
-            for theta_d in THETA_D:
-                for phi_d in PHI_D:
-                    if theta_d == 0: phi_d = 0
-                    ret.append((r, theta_d, phi_d))
-                    if theta_d == 0: break
-        return ret
+        return [tuple(p) for p in get_position_grid().tolist()]
+
+
+class Pacer():
+    """ Exchange rate control
+    active: `rate` packets/s, burst: back to back while a command is queued or running,
+    idle: the period doubles up to 1 / `idle_rate` once nothing happened for `idle_after` sec.
+    wake() ends an idle wait early, so a new command doesn't sit out the backoff.
+    """
+    def __init__(self, rate=1000, idle_rate=20, idle_after=0.5, burst=True, report_interval=1.0):
+        self.active_period = 1 / rate
+        self.idle_period = 1 / idle_rate
+        self.idle_after = idle_after
+        self.burst = burst
+        self.report_interval = report_interval
+        self.period = self.active_period
+        self.mode = 'active'
+        self.wakeup = threading.Event()
+        self.window_start = None  # set by the first wait(), thread_time() is per thread
+        self.stats = {'mode': self.mode, 'rate': 0.0, 'jitter_ms': 0.0, 'cpu': 0.0}
+
+    def reset_window(self, now):
+        self.window_start = now
+        self.cpu_start = time.thread_time()
+        self.num, self.sum, self.sumsq = 0, 0.0, 0.0
+
+    def wake(self):
+        self.wakeup.set()
+
+    def wait(self, busy):
+        """ Called once per exchange. Returns True when new stats are available
+        """
+        now = time.perf_counter()
+        if self.window_start is None:
+            self.last = self.last_active = now
+            self.reset_window(now)
+        if busy:
+            self.last_active = now
+            self.mode = 'burst' if self.burst else 'active'
+            self.period = 0 if self.burst else self.active_period
+        elif now - self.last_active < self.idle_after:
+            self.mode = 'active'
+            self.period = self.active_period
+        else:
+            self.mode = 'idle'
+            self.period = min(max(self.period, self.active_period) * 2, self.idle_period)
+
+        delay = self.last + self.period - now
+        if delay > 0 and self.wakeup.wait(delay):
+            self.last_active = time.perf_counter()
+        self.wakeup.clear()
+
+        now = time.perf_counter()
+        interval = now - self.last
+        self.last = now
+        self.num += 1
+        self.sum += interval
+        self.sumsq += interval * interval
+
+        elapsed = now - self.window_start
+        if elapsed < self.report_interval:
+            return False
+        mean = self.sum / self.num
+        self.stats = {
+            'mode': self.mode,
+            'rate': self.num / elapsed,
+            'jitter_ms': max(0, self.sumsq / self.num - mean * mean) ** 0.5 * 1000,
+            'cpu': (time.thread_time() - self.cpu_start) / elapsed * 100,  # % of a core, exchange thread
+        }
+        self.reset_window(now)
+        return True
 
 
 class Backend(Logger, EquipCtrl):
-    def __init__(self, tx_num, peri_num):
-        EquipCtrl.__init__(self, 0, 0)
+    verbose = True  # per command prints
+
+    def __init__(self, tx_num, peri_num, scheduler=None, history_depth=4096, pacer=None, log_path=None):
+        if scheduler is None:
+            EquipCtrl.__init__(self, 0, 0)
+        else:
+            EquipCtrl.__init__(self, 0, len(scheduler), scheduler)
         Param.tx_num = tx_num
         Param.peri_num = peri_num
-        super().__init__()
-        self.status = Status.READY
+        self.listeners = []
+        self._status = Status.READY
         self.upstrm = Upstream()
         self.dnstrm = Downstream()
+        self.rx_coords = [(0, 0, 0)] * Param.peri_num  # estimated by the GUI
+        self.history = History(peri_num, tx_num, depth=history_depth)
+        self.pacer = Pacer() if pacer is None else pacer
+        self.log_path = log_path
+        self.stopped = threading.Event()
         self.gui_signal, self.gui_sigdir = Command.NOP, 0
-        self.init_socket()
 
     def __del__(self):
-        self.sock.close()
+        if hasattr(self, 'sock'):
+            self.sock.close()
+
+    def setup(self):
+        """ Log file and socket are opened here, not at construction
+        """
+        if hasattr(self, 'sock'):
+            return
+        resumed = self.scheduler is not None and self.scheduler.done > 0
+        self.open_log(self.log_path, append=resumed)
+        self.init_socket()
+
+    def stop(self):
+        """ process() returns after the current exchange
+        """
+        self.stopped.set()
+        self.pacer.wake()
+
+    def info(self, s):
+        if self.verbose:
+            print(s)
 
     def init_socket(self):
         self.server_addr = ('192.168.0.10', 1248)
@@ -196,9 +366,35 @@ class Backend(Logger, EquipCtrl):
             print(f"{Fore.RED}{s}{Fore.RESET}")
         self.sock.settimeout(2)
     
+    """ Change notification
+    listeners are called from the backend thread as func(event, *args):
+    ('status', status), ('edge', cmd, direction), ('dnstrm',), ('pacer', stats)
+    """
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def notify(self, event, *args):
+        for func in self.listeners:
+            func(event, *args)
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        if status != self._status:
+            self._status = status
+            self.notify('status', status)
+
+    def set_edge(self, cmd, direction):
+        self.gui_signal, self.gui_sigdir = cmd, direction
+        self.notify('edge', cmd, direction)
+
     def set_cmd(self, cmd):
         if self.dnstrm.cmd_fired == Command.NOP:
             self.upstrm.cmd = cmd
+            self.pacer.wake()
 
     # @property
     # def running_cmd(self):
@@ -208,6 +404,9 @@ class Backend(Logger, EquipCtrl):
     def rx_infos(self):
         return self.dnstrm.peri_infos
 
+    def set_rx_coord(self, i, r, theta_d, phi_d):
+        self.rx_coords[i] = (r, theta_d, phi_d)
+
     @property
     def max_rx_num(self):
         return len(self.dnstrm.peri_infos)
@@ -216,7 +415,10 @@ class Backend(Logger, EquipCtrl):
         self.sock.sendto(self.upstrm.packed_data, self.client_addr)
         try:
             data, _ = self.sock.recvfrom(1248)
-            self.dnstrm.unpack_data(data)
+            if data != self.dnstrm.raw:
+                self.dnstrm = Downstream(data, self.dnstrm.seq + 1)
+                self.notify('dnstrm')
+            self.history.push(time.monotonic(), self.dnstrm)  # every packet, unchanged ones included
         except TimeoutError:
             self.status = Status.DISCONNECTED
             print(f"{Fore.CYAN}Waiting for client packet{Fore.RESET}")
@@ -225,35 +427,41 @@ class Backend(Logger, EquipCtrl):
             return 0
 
     def process(self):
+        self.setup()
         cmd_fired_prev = self.dnstrm.cmd_fired
-        while True:
+        while not self.stopped.is_set():
+            busy = self.upstrm.cmd != Command.NOP or self.dnstrm.cmd_fired != Command.NOP
+            if self.pacer.wait(busy):
+                self.notify('pacer', self.pacer.stats)
             if self.exchange_pkt():
                 continue
 
-            if self.pos_idx != self.pos_idx_prev:
+            if self.pos_idx != self.pos_idx_prev and self.pos_idx < self.end:
                 self.pos_idx_prev = self.pos_idx
-                print(f"{Fore.MAGENTA}set position to {self.curr_pos}{Fore.RESET}")
+                self.info(f"{Fore.MAGENTA}set position to {self.curr_pos}{Fore.RESET}")
                 # set position here
 
             """ Backend state machine
             """
             if self.upstrm.cmd != Command.NOP and self.upstrm.cmd == self.dnstrm.cmd_fired:
-                print(f"\n * Rising Edge - {Command(self.dnstrm.cmd_fired).name}")
+                self.info(f"\n * Rising Edge - {Command(self.dnstrm.cmd_fired).name}")
                 self.upstrm.cmd = Command.NOP
                 self.status = Status.BUSY
-                self.gui_signal, self.gui_sigdir = self.dnstrm.cmd_fired, 1
+                self.set_edge(self.dnstrm.cmd_fired, 1)
             elif self.dnstrm.cmd_fired != Command.NOP:
                 ...  # running
             elif cmd_fired_prev != Command.NOP and self.dnstrm.cmd_fired == Command.NOP:
-                print(f" * Falling Edge - {Command(cmd_fired_prev).name}")
+                self.info(f" * Falling Edge - {Command(cmd_fired_prev).name}")
                 self.status = Status.READY
                 match cmd_fired_prev:
                     case Command.SCAN:
-                        logging.info(self.get_csv_string())
+                        record, done = self.get_csv_string(), None
                         if self.pos_idx < self.end:
-                            self.pos_idx += 1
-                            print(f"progress: {self.pos_idx - self.start} / {self.end - self.start}")
-                self.gui_signal, self.gui_sigdir = cmd_fired_prev, -1
+                            self.next_pos()
+                            done = self.pos_idx
+                            self.info(f"progress: {self.pos_idx - self.start} / {self.end - self.start}")
+                        self.log(record, done=done)
+                self.set_edge(cmd_fired_prev, -1)
             else:  # elif self.upstrm.cmd == Command.NOP and self.dnstrm.cmd_fired == Command.NOP:
                 self.status = Status.READY
                 if self.pos_idx < self.end:
@@ -263,5 +471,5 @@ class Backend(Logger, EquipCtrl):
 
 
 if __name__ == "__main__":
-    backend = Backend()
+    backend = Backend(tx_num=Param.tx_num, peri_num=Param.peri_num)
     backend.process()
\ No newline at end of file
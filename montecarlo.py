@@ -0,0 +1,102 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sim import Esa, angle_between
+
+""" Monte Carlo phase-error and element-failure analysis
+every realization perturbs the ideal steering codes by a random integer code error
+(same range as dataset.Generator.add_line) and switches off random PAs. A batch of
+realizations is evaluated as one (directions x realizations) matrix product.
+"""
+
+
+class MonteCarlo():
+    def __init__(self, esa, n_bits=6, code_error=(-4, 3), p_dead=0.0, n_dead=0, degree_step=2, batch=256):
+        self.esa = esa
+        self.code_limit = 1 << n_bits
+        self.phase_step = 360 / self.code_limit
+        self.code_error = code_error  # inclusive range
+        self.p_dead = p_dead  # independent failure probability per PA
+        self.n_dead = n_dead  # or exactly this many dead PAs per realization
+        self.batch = batch
+
+        theta_d, phi_d = np.meshgrid(np.arange(degree_step, 90 + 1, degree_step),
+                                     np.arange(0, 360, degree_step), indexing='ij')
+        self.theta_d = np.append(0, theta_d.ravel())
+        self.phi_d = np.append(0, phi_d.ravel())
+        self.steering = esa.get_steering_matrix(np.deg2rad(self.theta_d), np.deg2rad(self.phi_d))
+
+    def get_alive(self, rng, n):
+        K = self.esa.tx_num
+        alive = rng.random((n, K)) >= self.p_dead
+        if self.n_dead:
+            dead = np.argsort(rng.random((n, K)), axis=1)[:, :self.n_dead]
+            np.put_along_axis(alive, dead, False, axis=1)
+        return alive
+
+    def run_angle(self, theta0_d, phi0_d, realizations, seed=None):
+        """ returns gain loss (dB) and pointing error (°) per realization
+        """
+        rng = np.random.default_rng(seed)
+        w = self.esa.weights.ravel()
+        a0 = self.esa.get_steering_matrix(np.deg2rad(theta0_d), np.deg2rad(phi0_d))
+        codes0 = np.rint(self.esa.get_desired_phase(theta0_d, phi0_d).ravel() / self.phase_step)
+        gain0 = abs(a0 @ (w * np.exp(1j * np.deg2rad(codes0 * self.phase_step))))
+
+        gain_loss, pointing_error = [], []
+        for o in range(0, realizations, self.batch):
+            n = min(self.batch, realizations - o)
+            lo, hi = self.code_error
+            codes = (codes0 + rng.integers(lo, hi + 1, (n, len(codes0)))) % self.code_limit
+            x = self.get_alive(rng, n) * w * np.exp(1j * np.deg2rad(codes * self.phase_step))  # (B, K)
+            gain = abs(x @ a0)
+            peak = np.argmax(abs(self.steering @ x.T), axis=0)
+            gain_loss.append(20 * np.log10(gain0 / np.maximum(gain, 1e-12)))
+            pointing_error.append(angle_between(self.theta_d[peak], self.phi_d[peak], theta0_d, phi0_d))
+        return np.concatenate(gain_loss), np.concatenate(pointing_error)
+
+
+def _run_shard(args):
+    mc, theta0_d, phi0_d, realizations, seed = args
+    return mc.run_angle(theta0_d, phi0_d, realizations, seed)
+
+
+def run(mc, angles, realizations=1000, seed=0, workers=None, shards=4):
+    """ angles: (A, 2) of (θ, φ), returns {(θ, φ): (gain_loss, pointing_error)}
+    every shard has its own spawned seed, so results don't depend on the number of workers
+    """
+    angles = [tuple(a) for a in np.asarray(angles).reshape(-1, 2).tolist()]
+    per_shard = -(-realizations // shards)
+    jobs = []
+    for angle, ss in zip(angles, np.random.SeedSequence(seed).spawn(len(angles))):
+        for s, child in enumerate(ss.spawn(shards)):
+            n = min(per_shard, realizations - s * per_shard)
+            if n > 0:
+                jobs.append((mc, *angle, n, child))
+
+    workers = workers or os.cpu_count()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_run_shard, jobs))
+    else:
+        results = list(map(_run_shard, jobs))
+
+    ret = {angle: ([], []) for angle in angles}
+    for job, (loss, error) in zip(jobs, results):
+        ret[job[1:3]][0].append(loss)
+        ret[job[1:3]][1].append(error)
+    return {angle: (np.concatenate(loss), np.concatenate(error)) for angle, (loss, error) in ret.items()}
+
+
+if __name__ == "__main__":
+    esa = Esa(8, 8)
+    angles = [(0, 0), (20, 200), (40, 300)]
+    print(f"{'dead PAs':>8} {'θ':>4} {'φ':>4} {'loss mean(dB)':>14} {'loss p95(dB)':>13} {'err mean(°)':>12} {'err p95(°)':>11}")
+    t = time.perf_counter()
+    for n_dead in (0, 1, 4, 8):
+        mc = MonteCarlo(esa, n_bits=6, n_dead=n_dead)
+        for (theta_d, phi_d), (loss, error) in run(mc, angles, realizations=2000).items():
+            print(f"{n_dead:8} {theta_d:4.0f} {phi_d:4.0f} {loss.mean():14.2f} {np.percentile(loss, 95):13.2f} "
+                  f"{error.mean():12.2f} {np.percentile(error, 95):11.2f}")
+    print(f"{time.perf_counter() - t:.1f}s")
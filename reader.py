@@ -0,0 +1,125 @@
+import os
+import numpy as np
+from itertools import islice
+
+""" Scan log schema
+rx#, R, θ, φ, ps#0 ... ps#(tx_num - 1), v_rfdc
+"""
+RX, R, THETA, PHI = 0, 1, 2, 3
+PS_OFFSET = 4
+V_RFDC = -1
+
+
+def parse_header(line):
+    columns = [c.strip() for c in line.split(',')]
+    if columns[:PS_OFFSET] != ["rx#", "R", "θ", "φ"] or columns[V_RFDC] != "v_rfdc":
+        raise ValueError(f"unknown scan log header: {line.strip()[:40]}...")
+    return columns
+
+
+def in_range(vals, rng):
+    if rng is None:
+        return np.ones(len(vals), dtype=bool)
+    lo, hi = rng
+    return (vals >= lo) & (vals <= hi)
+
+
+class ScanLog():
+    """ Chunked reader for the csv files written by Logger and dataset.Generator
+    The first read converts the csv into a column-major .npy next to it,
+    later reads memory-map that cache so R/θ/φ filters only touch those columns.
+    """
+    def __init__(self, path, chunk_size=1 << 16, cache=True):
+        self.path = path
+        self.chunk_size = chunk_size
+        if path.endswith('.npy'):  # e.g. dataset.generate_bulk output
+            self.cache_path = path
+            self.columns = None
+        else:
+            self.cache_path = f"{os.path.splitext(path)[0]}.npy"
+            with open(path, encoding='utf-8') as f:
+                self.columns = parse_header(f.readline())
+            if cache and not self.cache_valid:
+                self.build_cache()
+
+    @property
+    def cache_valid(self):
+        if self.cache_path == self.path:
+            return True
+        return os.path.exists(self.cache_path) and os.path.getmtime(self.cache_path) >= os.path.getmtime(self.path)
+
+    @property
+    def tx_num(self):
+        return self.shape[1] - PS_OFFSET - 1
+
+    @property
+    def shape(self):
+        if self.cache_valid:
+            return self.memmap().shape
+        return self.count_rows(), len(self.columns)
+
+    def memmap(self):
+        return np.load(self.cache_path, mmap_mode='r')
+
+    def count_rows(self):
+        with open(self.path, encoding='utf-8') as f:
+            f.readline()
+            return sum(1 for line in f if line.strip())
+
+    def iter_csv(self):
+        with open(self.path, encoding='utf-8') as f:
+            f.readline()
+            lines = (line for line in f if line.strip())
+            while True:
+                chunk = list(islice(lines, self.chunk_size))
+                if not chunk:
+                    return
+                yield np.loadtxt(chunk, delimiter=',', dtype=np.int32, ndmin=2)
+
+    def build_cache(self):
+        out = np.lib.format.open_memmap(f"{self.cache_path}.tmp", mode='w+', dtype=np.int32,
+                                        shape=(self.count_rows(), len(self.columns)), fortran_order=True)
+        o = 0
+        for rows in self.iter_csv():
+            out[o:o + len(rows)] = rows
+            o += len(rows)
+        out.flush()
+        del out
+        os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+    def iter_chunks(self, r=None, theta_d=None, phi_d=None):
+        """ Yield (n, columns) int32 arrays, keeping only rows inside the inclusive (lo, hi) ranges
+        """
+        if not self.cache_valid:
+            for rows in self.iter_csv():
+                mask = in_range(rows[:, R], r) & in_range(rows[:, THETA], theta_d) & in_range(rows[:, PHI], phi_d)
+                yield rows[mask]
+            return
+
+        data = self.memmap()
+        for o in range(0, len(data), self.chunk_size):
+            sl = slice(o, o + self.chunk_size)
+            mask = in_range(data[sl, R], r) & in_range(data[sl, THETA], theta_d) & in_range(data[sl, PHI], phi_d)
+            idx = np.flatnonzero(mask) + o
+            if len(idx):
+                yield np.asarray(data[idx])
+
+    def select(self, r=None, theta_d=None, phi_d=None):
+        chunks = list(self.iter_chunks(r, theta_d, phi_d))
+        if not chunks:
+            return np.zeros((0, self.shape[1]), dtype=np.int32)
+        return np.concatenate(chunks)
+
+    @staticmethod
+    def phases(rows):
+        return rows[:, PS_OFFSET:V_RFDC]
+
+
+if __name__ == "__main__":
+    import sys
+    for path in sys.argv[1:]:
+        log = ScanLog(path)
+        n = 0
+        for rows in log.iter_chunks():
+            n += len(rows)
+        print(f"{path}: {n} rows, {log.tx_num} elements")
@@ -0,0 +1,119 @@
+import os
+import time
+import shutil
+import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sim import Esa, THETA, PHI, spherical_to_cartesian, to_positive_angles
+
+""" Headless beam pattern rendering
+frames are split over worker processes, every worker draws on one reused figure
+with its own Agg canvas and writes numbered PNGs, ffmpeg joins them if present
+"""
+
+
+def phases_from_codes(esa, codes, n_bits):
+    """ (F, tx_num) hardware codes, e.g. ScanLog.phases(rows) -> (F, N, M) degrees
+    """
+    return np.maximum(0, esa.layout.to_sim(codes) * (360 / (1 << n_bits)))
+
+
+def phases_from_angles(esa, angles, n_bits=None):
+    """ codebook sweep, (F, 2) of (θ, φ) -> (F, N, M) degrees, quantized if n_bits is given
+    """
+    angles = np.asarray(angles, dtype=float).reshape(-1, 2)
+    phase_d = esa.get_desired_phase(angles[:, 0], angles[:, 1])
+    if n_bits:
+        step = 360 / (1 << n_bits)
+        phase_d = np.rint(phase_d / step) * step
+    return phase_d
+
+
+def _render_chunk(args):
+    M, N, positions, weights, phase_d, start, out_dir, mode, dpi = args
+    # own Agg canvas, no pyplot: the global backend of the calling process (e.g. the Qt GUI) stays untouched
+    from matplotlib import colormaps
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    esa = Esa(M, N, positions=positions)
+    esa.weights = weights
+    x = (weights * np.exp(1j * np.deg2rad(phase_d))).reshape(len(phase_d), -1)
+    R = abs(esa.get_steering_matrix(THETA, PHI) @ x.T)  # (phi, theta, F)
+    axis_length = np.abs(weights).sum() * 1.3
+
+    # axes and artists are set up once, frames only swap the data
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    if mode == '3d':
+        ax = fig.add_subplot(projection='3d')
+        ax.view_init(elev=110, azim=-105, roll=-15)
+        ax.set_xlim(-axis_length, axis_length)
+        ax.set_ylim(-axis_length, axis_length)
+        ax.set_zlim(0, axis_length)
+        ax.xaxis.set_ticklabels([])
+        ax.yaxis.set_ticklabels([])
+        ax.zaxis.set_ticklabels([])
+        surf = None
+    else:
+        ax = fig.add_subplot(projection='polar')
+        ax.set_thetamin(-90)
+        ax.set_thetamax(90)
+        ax.set_theta_zero_location('N')
+        ax.set_ylim(0, axis_length / 1.3)
+        line = ax.plot([], [], c='b', lw=1)[0]
+    title = ax.set_title("", color='#778899', weight='bold')
+
+    for f in range(len(phase_d)):
+        Rf = R[..., f]
+        idx = np.unravel_index(np.argmax(Rf), Rf.shape)
+        theta_d, phi_d = to_positive_angles(np.rad2deg(THETA[idx]), np.rad2deg(PHI[idx]))
+        if mode == '3d':
+            if surf is not None:
+                surf.remove()
+            surf = ax.plot_surface(*spherical_to_cartesian(Rf, THETA, PHI), cmap=colormaps['jet'],
+                                   lw=0.1, alpha=0.3, rstride=1, cstride=1, aa=True)
+        else:
+            # cut through the peak, θ from -90 to 90 along the peak φ
+            line.set_data(THETA[idx[0]], Rf[idx[0]])
+        title.set_text(f"#{start + f}  θ: {theta_d:.0f}°  φ: {phi_d:.0f}°")
+        fig.savefig(os.path.join(out_dir, f"frame_{start + f:05d}.png"), dpi=dpi)
+    return len(phase_d)
+
+
+def render(esa, phase_d, out_dir, mode='3d', dpi=80, workers=None, video=None, fps=10):
+    """ phase_d: (F, N, M) degrees in simulation order, mode: '3d' or 'polar'
+    video: optional output file (e.g. sweep.mp4), needs ffmpeg on PATH
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    phase_d = np.asarray(phase_d, dtype=float).reshape(-1, esa.N, esa.M)
+    workers = workers or os.cpu_count()
+    size = -(-len(phase_d) // workers)
+    jobs = [(esa.M, esa.N, esa.positions, esa.weights, phase_d[o:o + size], o, out_dir, mode, dpi)
+            for o in range(0, len(phase_d), size)]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            num_frames = sum(executor.map(_render_chunk, jobs))
+    else:
+        num_frames = sum(map(_render_chunk, jobs))
+
+    if video:
+        if shutil.which('ffmpeg') is None:
+            print("ffmpeg not found, frames are left as PNG")
+        else:
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+                            '-i', os.path.join(out_dir, 'frame_%05d.png'),
+                            '-pix_fmt', 'yuv420p', video], check=True)
+    return num_frames
+
+
+if __name__ == "__main__":
+    import sys
+
+    esa = Esa(8, 8)
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'polar'
+    theta_d, phi_d = np.meshgrid(np.arange(0, 45 + 1, 5), np.arange(0, 360, 10), indexing='ij')
+    angles = np.stack([theta_d.ravel(), phi_d.ravel()], axis=-1)
+    t = time.perf_counter()
+    n = render(esa, phases_from_angles(esa, angles, n_bits=6), './render', mode=mode, video='./render/sweep.mp4')
+    print(f"{n} frames in {time.perf_counter() - t:.1f}s")
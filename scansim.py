@@ -0,0 +1,100 @@
+import time
+import numpy as np
+from sim import Esa, angle_between
+from dataset import predict_power
+
+""" Offline scan strategy simulation
+every probe is a quantized steering beam, the peripheral reports the received power
+(predict_power at its distance times the normalized beam gain), and the strategy picks
+the probe with the highest report. Everything is vectorized across receiver positions.
+"""
+
+
+class ScanSim():
+    def __init__(self, esa, n_bits=6, probe_ms=1.0, noise=0.0, seed=None):
+        self.esa = esa
+        self.phase_step = 360 / (1 << n_bits)
+        self.probe_ms = probe_ms
+        self.noise = noise  # std of the reported power
+        self.rng = np.random.default_rng(seed)
+        self.gain_max = np.abs(esa.weights).sum()
+
+    def get_probe_phasors(self, theta_d, phi_d):
+        """ (..., K) weighted phasors of quantized steering codes
+        """
+        codes = np.rint(self.esa.get_desired_phase(theta_d, phi_d) / self.phase_step)
+        phase = np.deg2rad(codes * self.phase_step)
+        return (self.esa.weights * np.exp(1j * phase)).reshape(np.shape(theta_d) + (-1,))
+
+    def measure(self, positions, fields):
+        """ reported power of every probe field (P, S) at every position (P,)
+        """
+        gain = abs(fields) / self.gain_max
+        power = predict_power(positions[:, 0])[:, None] * gain ** 2
+        if self.noise:
+            power = power + self.rng.normal(0, self.noise, power.shape)
+        return power
+
+    def full_sweep(self, positions, theta_max=60, step=5):
+        theta_d, phi_d = np.meshgrid(np.arange(step, theta_max + 1, step), np.arange(0, 360, step), indexing='ij')
+        theta_d, phi_d = np.append(0, theta_d.ravel()), np.append(0, phi_d.ravel())
+        probes = self.get_probe_phasors(theta_d, phi_d)  # (G, K)
+        rx = self.esa.get_steering_matrix(*np.deg2rad(positions[:, 1:].T))  # (P, K)
+        power = self.measure(positions, rx @ probes.T)
+        best = np.argmax(power, axis=1)
+        return self.report(positions, theta_d[best], phi_d[best], np.full(len(positions), len(theta_d)))
+
+    def steering_scan(self, positions, theta_max=60, coarse_step=20, fine_step=5):
+        """ coarse grid, then 3x3 neighbourhood refinement with halving steps
+        """
+        rx = self.esa.get_steering_matrix(*np.deg2rad(positions[:, 1:].T))
+        P = len(positions)
+
+        theta_d, phi_d = np.meshgrid(np.arange(coarse_step, theta_max + 1, coarse_step),
+                                     np.arange(0, 360, coarse_step), indexing='ij')
+        theta_d, phi_d = np.append(0, theta_d.ravel()), np.append(0, phi_d.ravel())
+        probes = self.get_probe_phasors(theta_d, phi_d)
+        power = self.measure(positions, rx @ probes.T)
+        best = np.argmax(power, axis=1)
+        best_theta, best_phi, best_power = theta_d[best], phi_d[best], power[np.arange(P), best]
+        num_probes = np.full(P, len(theta_d))
+
+        step = coarse_step / 2
+        offsets = np.array([(dt, dp) for dt in (-1, 0, 1) for dp in (-1, 0, 1) if dt or dp])
+        while step >= fine_step:
+            cand_theta = np.clip(best_theta[:, None] + offsets[None, :, 0] * step, 0, theta_max)
+            cand_phi = (best_phi[:, None] + offsets[None, :, 1] * step) % 360
+            power = self.measure(positions, np.einsum('pk,psk->ps', rx, self.get_probe_phasors(cand_theta, cand_phi)))
+            i = np.argmax(power, axis=1)
+            better = power[np.arange(P), i] > best_power
+            best_theta = np.where(better, cand_theta[np.arange(P), i], best_theta)
+            best_phi = np.where(better, cand_phi[np.arange(P), i], best_phi)
+            best_power = np.maximum(best_power, power[np.arange(P), i])
+            num_probes += len(offsets)
+            step /= 2
+        return self.report(positions, best_theta, best_phi, num_probes)
+
+    def report(self, positions, theta_d, phi_d, num_probes):
+        return {
+            'theta_d': theta_d,
+            'phi_d': phi_d,
+            'probes': num_probes,
+            'scan_ms': num_probes * self.probe_ms,
+            'pointing_error': angle_between(theta_d, phi_d, positions[:, 1], positions[:, 2]),
+        }
+
+
+if __name__ == "__main__":
+    from scheduler import get_position_grid
+
+    esa = Esa(8, 8)
+    positions = get_position_grid(r=(50, 300, 50), theta_d=(0, 45, 3), phi_d=(180, 360, 7))
+    scansim = ScanSim(esa, n_bits=6, probe_ms=1.0, noise=5, seed=0)
+    print(f"{len(positions)} positions")
+    print(f"{'strategy':>16} {'probes':>7} {'scan(ms)':>9} {'err mean(°)':>12} {'err p95(°)':>11} {'sim(s)':>7}")
+    for name, func in [('steering', scansim.steering_scan), ('full-sweep', scansim.full_sweep)]:
+        t = time.perf_counter()
+        rep = func(positions)
+        elapsed = time.perf_counter() - t
+        print(f"{name:>16} {rep['probes'].mean():7.0f} {rep['scan_ms'].mean():9.1f} "
+              f"{rep['pointing_error'].mean():12.2f} {np.percentile(rep['pointing_error'], 95):11.2f} {elapsed:7.2f}")
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import numpy as np
+
+""" Positioner model
+travel time between two positions is the slowest axis, since all axes move at once
+"""
+SPEEDS = (5, 10, 20)  # R(cm/s), θ(°/s), φ(°/s)
+SETTLE = 1.0  # sec
+
+
+def arange_inclusive(start, stop, step):
+    return np.arange(start, stop + step / 2, step)
+
+
+def get_position_grid(r=(50, 300, 100), theta_d=(0, 45, 10), phi_d=(180, 360, 60)):
+    """ (r, θ, φ) positions in nested loop order, ranges are inclusive (start, stop, step)
+    """
+    R, THETA_D, PHI_D = np.meshgrid(arange_inclusive(*r), arange_inclusive(*theta_d), arange_inclusive(*phi_d),
+                                    indexing='ij')
+    grid = np.stack([R, THETA_D, PHI_D], axis=-1).reshape(-1, 3)
+    grid[grid[:, 1] == 0, 2] = 0  # φ is meaningless at boresight
+    _, idx = np.unique(grid, axis=0, return_index=True)
+    return grid[np.sort(idx)]
+
+
+def get_travel_times(a, b, speeds=SPEEDS, settle=SETTLE):
+    """ pairwise travel time matrix (P, Q) between position sets a (P, 3) and b (Q, 3), float32
+    memory is P * Q, large sets are processed a few rows of a at a time
+    """
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    t = np.zeros((len(a), len(b)), dtype=np.float32)
+    for axis, speed in enumerate(speeds):
+        np.maximum(t, np.abs(np.subtract.outer(a[:, axis], b[:, axis])) / np.float32(speed), out=t)
+    return t + np.float32(settle)
+
+
+def get_neighbours(nodes, k=8, chunk_size=1 << 22):
+    """ (P, k) indices of the k nearest positions by travel time, in row chunks of ~chunk_size entries
+    """
+    k = min(k, len(nodes) - 1)
+    rows = max(1, chunk_size // len(nodes))
+    ret = np.empty((len(nodes), k), dtype=np.int64)
+    for o in range(0, len(nodes), rows):
+        t = get_travel_times(nodes[o:o + rows], nodes)
+        t[np.arange(len(t)), np.arange(o, o + len(t))] = np.inf
+        ret[o:o + rows] = np.argpartition(t, k - 1, axis=1)[:, :k]
+    return ret
+
+
+def order_nearest_neighbour(nodes, start=0):
+    """ greedy path, one travel time row per step
+    """
+    n = len(nodes)
+    order = [start]
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    for _ in range(n - 1):
+        t = get_travel_times(nodes[order[-1]:order[-1] + 1], nodes)[0]
+        t[visited] = np.inf
+        nxt = int(np.argmin(t))
+        visited[nxt] = True
+        order.append(nxt)
+    return np.array(order)
+
+
+def improve_2opt(nodes, order, k=16, time_limit=2.0, speeds=SPEEDS, settle=SETTLE):
+    """ open path 2-opt, the first position stays fixed
+    only moves that connect a position to one of its k nearest neighbours are tried
+    """
+    order = order.copy()
+    n = len(order)
+    scaled = nodes / np.asarray(speeds, dtype=float)
+
+    def times(x, y):
+        return np.abs(scaled[x] - scaled[y]).max(axis=-1) + settle
+
+    neighbours = get_neighbours(nodes, k)
+    pos = np.empty(n, dtype=np.int64)
+    pos[order] = np.arange(n)
+    deadline = time.monotonic() + time_limit
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 1):
+            a, b = order[i - 1], order[i]
+            js = pos[neighbours[a]]
+            js = js[js > i]
+            if not len(js):
+                continue
+            c = order[js]
+            has_d = js < n - 1
+            d = order[np.minimum(js + 1, n - 1)]
+            gain = times(a, b) + np.where(has_d, times(c, d), 0) - times(a, c) - np.where(has_d, times(b, d), 0)
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-9:
+                seg = slice(i, js[j] + 1)
+                order[seg] = order[seg][::-1]
+                pos[order[seg]] = np.arange(i, js[j] + 1)
+                improved = True
+            if time.monotonic() >= deadline:
+                break
+    return order
+
+
+def get_path_time(nodes, order, speeds=SPEEDS, settle=SETTLE):
+    steps = np.abs(np.diff(nodes[order], axis=0)) / np.asarray(speeds, dtype=float)
+    return float((steps.max(axis=1) + settle).sum())
+
+
+class Scheduler():
+    """ Movement optimized measurement sequence with on-disk progress
+    """
+    def __init__(self, r=(50, 300, 100), theta_d=(0, 45, 10), phi_d=(180, 360, 60),
+                 checkpoint=None, optimize=True, home=(0, 0, 0)):
+        self.checkpoint = checkpoint
+        self.done = 0
+        grid = get_position_grid(r, theta_d, phi_d)
+
+        if checkpoint and os.path.exists(checkpoint):
+            try:
+                with open(checkpoint) as f:
+                    state = json.load(f)
+                positions = state['positions']
+                saved = np.array(positions, dtype=float).reshape(-1, 3)
+            except (ValueError, KeyError, TypeError):
+                print(f"ignore {checkpoint}: unreadable")
+            else:
+                if len(saved) == len(grid) and np.array_equal(np.unique(saved, axis=0), np.unique(grid, axis=0)):
+                    self.positions = [tuple(p) for p in positions]
+                    self.done = self.load_done(state.get('done', 0))
+                    print(f"resume from {checkpoint}: {self.done} / {len(self.positions)}")
+                    return
+                print(f"ignore {checkpoint}: position grid has changed")
+
+        if optimize and len(grid) > 2:
+            nodes = np.vstack([home, grid])
+            order = improve_2opt(nodes, order_nearest_neighbour(nodes, start=0))
+            before = get_path_time(nodes, np.arange(len(nodes)))
+            after = get_path_time(nodes, order)
+            print(f"travel time: {before:.0f}s -> {after:.0f}s")
+            grid = nodes[order[1:]]
+        self.positions = [tuple(p) for p in grid.tolist()]
+        if checkpoint:
+            self.write(checkpoint, {'positions': self.positions})
+        self.save(0)
+
+    def __len__(self):
+        return len(self.positions)
+
+    """ Checkpoint
+    the positions are written once, progress goes to a small side file `<checkpoint>.done`
+    """
+    @staticmethod
+    def write(path, state):
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    def load_done(self, default=0):
+        try:
+            with open(f"{self.checkpoint}.done") as f:
+                done = int(json.load(f)['done'])
+        except (OSError, ValueError, KeyError, TypeError):
+            done = default  # older checkpoints kept `done` next to the positions
+        return min(max(0, int(done)), len(self.positions))
+
+    def save(self, done):
+        self.done = done
+        if self.checkpoint:
+            self.write(f"{self.checkpoint}.done", {'done': done})
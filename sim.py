@@ -1,10 +1,12 @@
 #!/home/sis/.pyenv/shims/python3
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+import kernels
+from functools import wraps
+from collections import OrderedDict
 
 # constants
-c = 3e11
+c = 3e11  # mm/s, lengths are in mm
+cm = 10  # mm, receiver distances are in cm
 
 # parameters
 Fin = 5.8e9
@@ -30,24 +32,170 @@ def spherical_to_cartesian(r, theta_r, phi_r):
     z = r * np.cos(theta_r)
     return x, y, z
 
+def angle_between(theta1_d, phi1_d, theta2_d, phi2_d):
+    """ great-circle angle in degrees
+    """
+    t1, p1, t2, p2 = map(np.deg2rad, (theta1_d, phi1_d, theta2_d, phi2_d))
+    dot = u(t1, p1) * u(t2, p2) + v(t1, p1) * v(t2, p2) + np.cos(t1) * np.cos(t2)
+    return np.rad2deg(np.arccos(np.clip(dot, -1, 1)))
+
+def to_positive_angles(theta_d, phi_d):
+    """ plotting grid angles (θ may be negative) -> θ >= 0, φ in [0, 360)
+    """
+    if theta_d == 0:
+        phi_d = 0
+    elif theta_d < 0:
+        phi_d += 180
+    else:
+        phi_d += 360
+    return abs(theta_d), phi_d % 360
+
+def positions_to_points(positions):
+    """ (P, 3) of (r[cm], θ[°], φ[°]) as used by EquipCtrl -> (P, 3) cartesian points in mm
+    """
+    r, theta_d, phi_d = np.asarray(positions, dtype=float).T
+    return np.stack(spherical_to_cartesian(r * cm, np.deg2rad(theta_d), np.deg2rad(phi_d)), axis=-1)
+
 """ Plotting constants
 """
 DEGREE_STEP = 5
 _THETA = np.arange(-90, 90 + 1, DEGREE_STEP)
 _PHI = np.arange(-180, 180 + 1, DEGREE_STEP)
 THETA, PHI = np.deg2rad(np.meshgrid(_THETA, _PHI))
+CUT_ANGLE = np.arange(-90, 90 + 1, 1)  # principal cuts
+
+
+class Layout():
+    """ Element order mapping between hardware (tx index) and simulation (n, m)
+    Hardware index i sits at panel row n = i // M, column m = i % M.
+    The simulation grid is the panel flipped and rotated as configured,
+    the default full flip matches the mounting of the current boards.
+    """
+    def __init__(self, M, N, flip_m=True, flip_n=True, rotate=0):
+        self.M, self.N = M, N
+        self.hw_index = np.arange(M * N).reshape(N, M)
+        grid = self.hw_index
+        if flip_m:
+            grid = grid[:, ::-1]
+        if flip_n:
+            grid = grid[::-1, :]
+        grid = np.rot90(grid, rotate)
+        assert grid.shape == (N, M), "odd rotations need a square array"
+        self.sim_from_hw = grid.ravel()  # gather: sim.ravel() = hw[sim_from_hw]
+        self.hw_from_sim = np.argsort(self.sim_from_hw)  # gather: hw = sim.ravel()[hw_from_sim]
+
+    def hw_position(self, i):
+        """ panel (n, m) of hardware index i
+        """
+        return np.unravel_index(i, (self.N, self.M))
+
+    def to_sim(self, hw):
+        """ (..., M * N) hardware order -> (..., N, M) simulation order
+        """
+        hw = np.asarray(hw)
+        return hw[..., self.sim_from_hw].reshape(hw.shape[:-1] + (self.N, self.M))
+
+    def to_hw(self, sim):
+        """ (..., N, M) simulation order -> (..., M * N) hardware order
+        """
+        sim = np.asarray(sim)
+        return sim.reshape(sim.shape[:-2] + (-1,))[..., self.hw_from_sim]
+
+    def to_panel(self, hw):
+        """ (..., M * N) hardware order -> (..., N, M) as seen on the panel
+        """
+        hw = np.asarray(hw)
+        return hw.reshape(hw.shape[:-1] + (self.N, self.M))
+
+
+""" Memoization
+direction and pattern queries keyed on the phase bytes and the weights
+"""
+class LruCache():
+    def __init__(self, size=256):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, compute):
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        val = compute()
+        if isinstance(val, np.ndarray):
+            val.flags.writeable = False
+        if self.size > 0:
+            self.data[key] = val
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+        return val
+
+    def clear(self):
+        self.data.clear()
+
+    def resize(self, size):
+        self.size = size
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0,
+                'entries': len(self.data), 'size': self.size}
+
+
+def memoize(method):
+    def to_key(arg):
+        if isinstance(arg, np.ndarray):
+            return arg.dtype.str, arg.shape, arg.tobytes()
+        return arg
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        esa = getattr(self, 'esa', self)
+        key = (method.__name__, id(self), esa.weights.tobytes(), *map(to_key, args),
+               *((k, to_key(v)) for k, v in sorted(kwargs.items())))
+        return esa.cache.get(key, lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+def grid_positions(M, N, dx=dx, dy=dy):
+    """ (N * M, 3) regular half wavelength grid in simulation order, row n = 0 on top
+    """
+    xms = np.arange(0.5 - M / 2, M / 2, 1) * dx
+    yns = np.flip(np.arange(0.5 - N / 2, N / 2, 1) * dy)
+    X, Y = np.meshgrid(xms, yns)
+    return np.stack([X.ravel(), Y.ravel(), np.zeros(X.size)], axis=-1)
 
 
 class Esa():
-    def __init__(self, M, N):
+    """ positions: optional (N * M, 2 or 3) element positions in mm, simulation order,
+    for irregular panels (use M = K, N = 1 if K doesn't factor into the hardware grid)
+    active: optional (N * M,) or (N, M) mask, inactive elements have zero weight (thinning)
+    """
+    def __init__(self, M, N, cache_size=256, positions=None, active=None):
         self.M, self.N = M, N
+        self.layout = Layout(M, N)
+        self.cache = LruCache(cache_size)
+        self.propagation_cache = LruCache(8)
+        self.cut_cache = LruCache(128)
+        self.view = '3d'
         self.theta0_d, self.phi0_d = 0, 0
         self.phases = np.zeros((self.N, self.M), dtype=float)
 
-        self.weights = np.full((self.N, self.M), Ampl)
-        self.xms = np.arange(0.5 - self.M / 2, self.M / 2, 1) * dx
-        self.yns = np.arange(0.5 - self.N / 2, self.N / 2, 1) * dy
-        self.yns = np.flip(self.yns)
+        if positions is None:
+            positions = grid_positions(M, N)
+        positions = np.asarray(positions, dtype=float)
+        assert positions.shape in [(self.tx_num, 2), (self.tx_num, 3)], f"positions must be ({self.tx_num}, 2|3)"
+        self.positions = np.pad(positions, ((0, 0), (0, 3 - positions.shape[1])))
+        self.planar = not self.positions[:, 2].any()
+        self.kxyz = k * self.positions
+        self.active = np.ones((N, M), dtype=bool) if active is None else np.asarray(active, dtype=bool).reshape(N, M)
+
+        self.weights = np.full((self.N, self.M), Ampl) * self.active
 
     def set_target_angle(self, theta_d, phi_d):
         self.theta0_d, self.phi0_d = theta_d, phi_d
@@ -60,61 +208,134 @@ class Esa():
         return self.M * self.N
 
     def set_amplitude(self, amplitude):
-        self.weights.fill(amplitude)
+        self.weights[:] = amplitude * self.active
+        self.cache.clear()
 
+    @memoize
     def get_vector(self, phases):
         class _Vector():
             def __init__(self, theta, phi):
                 self.theta = theta
                 self.phi = phi
-        pattern_data = self.get_pattern_data_by_phased_array(phases)
-        idx = np.unravel_index(np.argmax(pattern_data, axis=None), pattern_data.shape)
-        theta, phi = np.rad2deg(THETA[idx]), np.rad2deg(PHI[idx])
-
-        # positive number conversion
-        if theta == 0:
-            phi = 0
-        elif theta < 0:
-            phi += 180
-        else:
-            phi += 360
-        theta, phi = abs(theta), phi % 360
+        x = (self.weights * np.exp(1j * np.deg2rad(phases))).ravel()
+        i, _ = kernels.get().peak(self.grid_steering, x)
+        idx = np.unravel_index(i, PHI.shape)
+        return _Vector(*to_positive_angles(np.rad2deg(THETA[idx]), np.rad2deg(PHI[idx])))
+
+    def get_steering_matrix(self, theta_r, phi_r):
+        """ element phase terms e^{jk(xu + yv + zw)} with shape (..., N * M)
+        """
+        return self.get_steering_matrix_uv(u(theta_r, phi_r), v(theta_r, phi_r))
 
-        return _Vector(theta, phi)
+    def get_steering_matrix_uv(self, u0, v0):
+        """ directions by their cosines, w follows from u and v (upper hemisphere)
+        """
+        kx, ky, kz = self.kxyz.T
+        u0, v0 = np.expand_dims(u0, -1), np.expand_dims(v0, -1)
+        if self.planar:
+            return np.exp(1j * (kx * u0 + ky * v0))
+        w0 = np.sqrt(np.maximum(0, 1 - u0 ** 2 - v0 ** 2))
+        return np.exp(1j * (kx * u0 + ky * v0 + kz * w0))
+
+    @property
+    def grid_steering(self):
+        """ (G, K) steering over the plotting grid THETA, PHI
+        """
+        if not hasattr(self, '_grid_steering'):
+            self._grid_steering = self.get_steering_matrix(THETA, PHI).reshape(-1, self.tx_num)
+        return self._grid_steering
 
+    @property
+    def codebook(self):
+        if not hasattr(self, '_codebook'):
+            self._codebook = Codebook(self)
+        return self._codebook
+
+    def get_cut_steering(self, theta_d, phi_d):
+        """ (2, L, K) steering along the E-plane (great circle through boresight and the peak)
+        and the H-plane (great circle through the peak, orthogonal to the E-plane)
+        """
+        def compute():
+            t = np.deg2rad(CUT_ANGLE)
+            theta_r, phi_r = np.deg2rad(theta_d), np.deg2rad(phi_d)
+            e_u, e_v = np.sin(t) * np.cos(phi_r), np.sin(t) * np.sin(phi_r)
+            h_u = np.cos(t) * u(theta_r, phi_r) - np.sin(t) * np.sin(phi_r)
+            h_v = np.cos(t) * v(theta_r, phi_r) + np.sin(t) * np.cos(phi_r)
+            return self.get_steering_matrix_uv(np.stack([e_u, h_u]), np.stack([e_v, h_v]))
+        return self.cut_cache.get((theta_d, phi_d), compute)
+
+    def get_principal_cuts(self, phase_d, theta_d, phi_d):
+        """ |AF| over CUT_ANGLE for the E-plane and the H-plane through (θ, φ), shape (2, L)
+        """
+        x = (self.weights * np.exp(1j * np.deg2rad(phase_d))).ravel()
+        return abs(self.get_cut_steering(theta_d, phi_d) @ x)
+
+    @memoize
     def get_pattern_data_by_target_angle(self, theta_d, phi_d):
-        theta_r, phi_r = np.deg2rad(theta_d), np.deg2rad(phi_d)
-        u0, v0 = u(theta_r, phi_r), v(theta_r, phi_r)
-        r = np.zeros(np.shape(PHI))
-        for n, yn in enumerate(self.yns):
-            for m, xm in enumerate(self.xms):
-                r = r + self.weights[n][m] * np.exp(1j * (
-                    k * (xm * (u(THETA, PHI) - u0) + yn * (v(THETA, PHI) - v0))
-                ))
-        return abs(r)
+        a0 = self.get_steering_matrix(np.deg2rad(theta_d), np.deg2rad(phi_d))
+        x = self.weights.ravel() * np.conj(a0)
+        return kernels.get().pattern(self.grid_steering, x).reshape(PHI.shape)
 
+    @memoize
     def get_pattern_data_by_phased_array(self, phase_d):
-        phase = np.deg2rad(phase_d)
-        r = np.zeros(np.shape(PHI))
-        for n, yn in enumerate(self.yns):
-            for m, xm in enumerate(self.xms):
-                r = r + self.weights[n][m] * np.exp(1j * (
-                    k * (xm * u(THETA, PHI) + yn * v(THETA, PHI)) +
-                    phase[n][m]
-                ))
-        return abs(r)
+        x = (self.weights * np.exp(1j * np.deg2rad(phase_d))).ravel()
+        return kernels.get().pattern(self.grid_steering, x).reshape(PHI.shape)
 
     def get_desired_phase(self, theta_d, phi_d):
-        theta_r, phi_r = np.deg2rad(theta_d), np.deg2rad(phi_d)
-        phase_d = np.ndarray((self.N, self.M))
-        for n, yn in enumerate(self.yns):
-            for m, xm in enumerate(self.xms):
-                cmplx = np.exp(-1j * k * (xm * u(theta_r, phi_r) + yn * v(theta_r, phi_r)))
-                phase_d[n][m] = np.angle(cmplx, deg=True)
-        phase_d[phase_d < 0] += 360
-        return phase_d
+        """ theta_d and phi_d may be arrays, the result has shape (..., N, M)
+        """
+        theta_r, phi_r = np.broadcast_arrays(np.deg2rad(theta_d), np.deg2rad(phi_d))
+        uvw = np.stack([u(theta_r, phi_r), v(theta_r, phi_r), np.cos(theta_r)], axis=-1).reshape(-1, 3)
+        phase_d = kernels.get().desired_phase(self.kxyz, uvw)
+        return phase_d.reshape(np.shape(theta_r) + (self.N, self.M))
+
+    """ Near-field
+    exact spherical-wave sum from every element to arbitrary points, for receivers inside
+    the far-field boundary (2D²/λ is ~40cm for 8x8 at 5.8GHz)
+    """
+    @property
+    def element_xyz(self):
+        return self.positions
+
+    def get_distances(self, points):
+        """ (P, 3) points in mm -> (P, N * M) element distances
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        return np.linalg.norm(points[:, None, :] - self.element_xyz[None, :, :], axis=-1)
+
+    def get_propagation_matrix(self, points):
+        """ e^{-jkd} / d per point and element, cached since the EquipCtrl points repeat
+        """
+        points = np.ascontiguousarray(points, dtype=float).reshape(-1, 3)
+        def compute():
+            d = self.get_distances(points)
+            return np.exp(-1j * k * d) / d
+        if len(points) * self.tx_num > 1 << 20:  # too large to keep around
+            return compute()
+        return self.propagation_cache.get(points.tobytes(), compute)
+
+    def get_near_field(self, points, phase_d):
+        """ |field| at (P, 3) points in mm scaled by the distance from the array center,
+        so it converges to the array factor of get_pattern_data_by_phased_array in the far field.
+        phase_d may be (N, M) or a batch (B, N, M), the result is (P,) or (B, P)
+        """
+        H = self.get_propagation_matrix(points)
+        phase = np.deg2rad(phase_d)
+        x = (self.weights * np.exp(1j * phase)).reshape(phase.shape[:-2] + (-1,))
+        r = np.linalg.norm(np.asarray(points, dtype=float).reshape(-1, 3), axis=-1)
+        return abs(x @ H.T) * r
+
+    def get_focusing_phase(self, points):
+        """ phases (..., N, M) in [0, 360) that add up coherently at each point
+        """
+        d = self.get_distances(points)
+        phase_d = np.rad2deg(k * d) % 360
+        return phase_d.reshape(np.shape(points)[:-1] + (self.N, self.M))
 
     def plot(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
+
         fig = plt.figure()
         fig.subplots_adjust(left=.03, right=.97)
 
@@ -134,24 +355,78 @@ class Esa():
         self.ax.set_xlim(-axis_length, axis_length)
         self.ax.set_ylim(-axis_length, axis_length)
 
-        X2, Y2 = np.meshgrid(self.xms, self.yns)
-        Z2 = np.zeros_like(X2)
-        self.ax.scatter(X2, Y2, Z2, marker='o', s=30)
+        active = self.active.ravel()
+        self.ax.scatter(*self.positions[active].T, marker='o', s=30)
+        self.ax.scatter(*self.positions[~active].T, marker='o', s=30, facecolors='none', edgecolors='grey')
         """
-        for n in range(self.N):
-            for m in range(self.M):
-                self.ax.text(self.xms[m], self.yns[n], 0, f"{self.M * n + m}", c='g', size=7, ha='center', va='center')
+        for i, (x, y, z) in enumerate(self.positions):
+            self.ax.text(x, y, z, f"{i}", c='g', size=7, ha='center', va='center')
         """
         
-        self.angle_text = self.ax.text(self.xms[-1] + dx / 4, self.yns[0] + dy / 4, 0, "", ha='left', va='bottom')
+        x, y, _ = self.positions.max(axis=0)
+        self.angle_text = self.ax.text(x + dx / 4, y + dy / 4, 0, "", ha='left', va='bottom')
 
         for receiver in receivers:
             receiver.init(self.ax)
 
-        self.ani = FuncAnimation(fig, self.update, interval=100)
+        """ Principal cut view
+        blitted on its own timer, only the line artists are redrawn per frame
+        """
+        self.ax_cut = fig.add_axes([.1, .1, .85, .8])
+        self.ax_cut.set_title("Principal Cuts", color='#778899', size=15, weight='bold', va='bottom')
+        self.ax_cut.set_xlim(CUT_ANGLE[0], CUT_ANGLE[-1])
+        self.ax_cut.set_xlabel("angle (°)")
+        self.ax_cut.grid(True)
+        self.e_line = self.ax_cut.plot(CUT_ANGLE, np.zeros(len(CUT_ANGLE)), c='r', lw=1, label='E-plane (θ)', animated=True)[0]
+        self.h_line = self.ax_cut.plot(CUT_ANGLE, np.zeros(len(CUT_ANGLE)), c='b', lw=1, label='H-plane (from peak)', animated=True)[0]
+        self.ax_cut.legend(loc='upper right')
+        self.cut_text = self.ax_cut.text(0.02, 0.95, "", transform=self.ax_cut.transAxes, va='top', animated=True)
+        self.cut_ylim = 0
+        self.cut_bg = None
+        self.cut_timer = fig.canvas.new_timer(interval=20)
+        self.cut_timer.add_callback(self.update_cut)
+        fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+        self.fig = fig
+        self.ani = FuncAnimation(fig, self.update, interval=100, cache_frame_data=False)
+        self.set_view(self.view)
         return fig
 
+    def set_view(self, view):
+        """ '3d' surface or 'cut' for the low latency E/H-plane view
+        """
+        self.view = view
+        self.ax.set_visible(view == '3d')
+        self.ax_cut.set_visible(view == 'cut')
+        self.cut_bg = None
+        if view == 'cut':
+            self.ani.pause()
+            self.cut_timer.start()
+        else:
+            self.cut_timer.stop()
+            self.ani.resume()
+        self.fig.canvas.draw_idle()
+
+    def toggle_view(self):
+        self.set_view('cut' if self.view == '3d' else '3d')
+
+    def on_draw(self, _):
+        """ full redraws (resize, view switch) renew the blit background
+        """
+        if self.view == 'cut':
+            self.cut_bg = self.fig.canvas.copy_from_bbox(self.ax_cut.bbox)
+            self.blit_cut()
+
+    def blit_cut(self):
+        canvas = self.fig.canvas
+        canvas.restore_region(self.cut_bg)
+        for artist in (self.e_line, self.h_line, self.cut_text):
+            self.ax_cut.draw_artist(artist)
+        canvas.blit(self.ax_cut.bbox)
+
     def update(self, _):
+        import matplotlib.pyplot as plt
+
         if 0:
             R = self.get_pattern_data_by_target_angle(self.theta0_d, self.phi0_d)
         else:
@@ -171,6 +446,44 @@ class Esa():
         for receiver in receivers:
             receiver.update()
 
+    def update_cut(self):
+        theta_d, phi_d, _ = self.codebook.lookup(self.phases)
+        self.set_target_angle(theta_d, phi_d)
+        e_cut, h_cut = self.get_principal_cuts(self.phases, theta_d, phi_d)
+        self.e_line.set_ydata(e_cut)
+        self.h_line.set_ydata(h_cut)
+        self.cut_text.set_text(f"θ: {theta_d:.0f}°  φ: {phi_d:.0f}°")
+
+        ylim = np.abs(self.weights).sum() * 1.1
+        if ylim != self.cut_ylim:
+            self.cut_ylim = ylim
+            self.ax_cut.set_ylim(0, ylim)
+            self.fig.canvas.draw_idle()  # the ticks change, blit again from on_draw
+        elif self.cut_bg is not None:
+            self.blit_cut()
+
+
+class Codebook():
+    """ Steering directions indexed by their element phasors
+    A lookup is one matched-filter product against every direction of the upper hemisphere
+    instead of a full pattern and argmax, and it ignores common phase offsets.
+    """
+    def __init__(self, esa, degree_step=DEGREE_STEP):
+        self.esa = esa
+        theta_d, phi_d = np.meshgrid(np.arange(degree_step, 90 + 1, degree_step),
+                                     np.arange(0, 360, degree_step), indexing='ij')
+        self.theta_d = np.append(0, theta_d.ravel())
+        self.phi_d = np.append(0, phi_d.ravel())
+        self.steering = esa.get_steering_matrix(np.deg2rad(self.theta_d), np.deg2rad(self.phi_d))
+
+    @memoize
+    def lookup(self, phases_d):
+        """ returns (θ, φ, confidence), confidence is 1 for a perfectly coherent beam
+        """
+        x = self.esa.weights.ravel() * np.exp(1j * np.deg2rad(phases_d).ravel())
+        i, r = kernels.get().peak(self.steering, x)
+        return self.theta_d[i], self.phi_d[i], r / np.abs(self.esa.weights).sum()
+
 
 class Receiver():
     def __init__(self, name):
@@ -207,6 +520,8 @@ receivers = [Receiver(f"Rx#{i + 1}") for i in range(5)]
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     esa = Esa(8, 8)
     fig = esa.plot()
 
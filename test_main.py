@@ -0,0 +1,32 @@
+import logging
+import numpy as np
+from main import Backend, Downstream, Command
+
+
+def test_scan_without_campaign_is_logged(tmp_path, monkeypatch):
+    """ a GUI started SCAN (no EquipCtrl positions) still writes its CSV row
+    """
+    path = tmp_path / 'log.csv'
+    backend = Backend(tx_num=16, peri_num=1, log_path=str(path))
+    monkeypatch.setattr(backend, 'init_socket', lambda: None)
+    monkeypatch.setattr(logging.getLogger(), 'handlers', [])  # pytest's capture handler would keep basicConfig from opening the log
+    frames = [Command.SCAN, Command.SCAN, Command.NOP]
+
+    def exchange_pkt():
+        if not frames:
+            backend.stop()
+            return 1
+        data = np.zeros(256 + 128, dtype=np.uint8)
+        data[0] = frames.pop(0)
+        data[256:262] = [1, 2, 3, 4, 5, 6]  # one connected peripheral
+        backend.dnstrm = Downstream(data.tobytes(), backend.dnstrm.seq + 1)
+        return 0
+
+    monkeypatch.setattr(backend, 'exchange_pkt', exchange_pkt)
+    backend.set_cmd(Command.SCAN)
+    backend.process()
+    backend.close_log()
+
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("1, 0, 0, 0")
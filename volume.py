@@ -0,0 +1,77 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sim import Esa
+from dataset import predict_power
+
+""" Received power volume map
+power(R, θ, φ) = predict_power(R) * normalized gain(θ, φ)^2
+The output is a (R, θ, φ) float32 .npy written through a memory map, θ slab by θ slab,
+so neither the volume nor the intermediates have to fit in RAM.
+"""
+
+
+def get_gain(esa, theta_d, phi_d, phase_d=None, n_bits=6):
+    """ normalized gain over a (T, F) angle grid
+    phase_d: fixed beam (N, M) in degrees, or None to steer to every direction (scan loss included)
+    """
+    A = esa.get_steering_matrix(np.deg2rad(theta_d), np.deg2rad(phi_d))  # (T, F, K)
+    w = esa.weights.ravel()
+    if phase_d is None:
+        phase_step = 360 / (1 << n_bits)
+        codes = np.rint(esa.get_desired_phase(theta_d, phi_d) / phase_step)
+        x = w * np.exp(1j * np.deg2rad(codes * phase_step)).reshape(A.shape)
+        field = (A * x).sum(axis=-1)
+    else:
+        field = A @ (w * np.exp(1j * np.deg2rad(phase_d)).ravel())
+    return abs(field) / np.abs(w).sum()
+
+
+def _fill_slab(args):
+    path, M, N, positions, weights, phase_d, n_bits, r, theta_d, phi_d, t0 = args
+    esa = Esa(M, N, positions=positions)
+    esa.weights = weights
+    T, F = np.meshgrid(theta_d, phi_d, indexing='ij')
+    gain = get_gain(esa, T, F, phase_d, n_bits)
+    out = np.load(path, mmap_mode='r+')
+    # straight into the float32 slab, no full size float64 temporary
+    np.multiply(predict_power(r)[:, None, None], (gain ** 2)[None], out=out[:, t0:t0 + len(theta_d), :])
+    out.flush()
+    return len(theta_d)
+
+
+def build_volume(path, esa, r, theta_d, phi_d, phase_d=None, n_bits=6, workers=None, chunk_bytes=64 << 20):
+    """ r, theta_d, phi_d: 1D axes, returns the memory-mapped (R, θ, φ) volume
+    """
+    r, theta_d, phi_d = map(np.asarray, (r, theta_d, phi_d))
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(r), len(theta_d), len(phi_d)))
+    del out
+
+    # bound the larger of the complex steering block and the float32 output slab, written in place
+    row_bytes = len(phi_d) * max(esa.tx_num * 48, len(r) * 4)
+    rows = max(1, int(chunk_bytes // row_bytes))
+    jobs = [(path, esa.M, esa.N, esa.positions, esa.weights, phase_d, n_bits, r, theta_d[t0:t0 + rows], phi_d, t0)
+            for t0 in range(0, len(theta_d), rows)]
+
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(_fill_slab, jobs):
+                pass
+    else:
+        for job in jobs:
+            _fill_slab(job)
+    return np.load(path, mmap_mode='r')
+
+
+if __name__ == "__main__":
+    esa = Esa(8, 8)
+    r = np.arange(50, 500 + 1, 1)
+    theta_d = np.arange(0, 90 + 1, 0.5)
+    phi_d = np.arange(0, 360, 0.5)
+    t = time.perf_counter()
+    vol = build_volume('./volume.npy', esa, r, theta_d, phi_d)
+    elapsed = time.perf_counter() - t
+    print(f"{vol.shape} ({vol.nbytes / 2**20:.0f}MB) in {elapsed:.1f}s")
+    print(f"power range: {vol.min():.0f} ~ {vol.max():.0f}")